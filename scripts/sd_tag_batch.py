@@ -1,11 +1,30 @@
 import gradio as gr
 import re
-from modules import scripts, deepbooru, script_callbacks, shared
+from modules import scripts, deepbooru, devices, lowvram, script_callbacks, shared
 from modules.ui_components import InputAccordion
 from modules.processing import process_images
 from modules.shared import state
 import sys
 import importlib.util
+import base64
+import contextlib
+import functools
+import hashlib
+import heapq
+import inspect
+import io
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import asdict, dataclass, field, replace
+from PIL import Image
+import numpy as np
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union, get_args, get_origin, get_type_hints
 
 NAME = "Img2img Batch Interrogator"
 
@@ -64,6 +83,1218 @@ def import_module(module_name, file_path):
     spec.loader.exec_module(module)
     return module
 
+# Clip-Ext begins and ends a WebUI job of its own around its calls, resetting state.job system of the running
+# img2img batch and clearing a pending interrupt. Every call into it runs inside this, on whatever thread (img2img,
+# scheduler, API worker) makes it, so the WebUI job gets its own state back; interrupts and skips are kept.
+webui_state_lock = threading.Lock()
+
+@contextlib.contextmanager
+def preserved_webui_state():
+    with webui_state_lock:
+        job, job_no, job_count = state.job, state.job_no, state.job_count
+        interrupted, skipped = state.interrupted, state.skipped
+        try:
+            yield
+        finally:
+            state.job, state.job_no, state.job_count = job, job_no, job_count
+            state.interrupted = state.interrupted or interrupted
+            state.skipped = state.skipped or skipped
+
+# Keyword options for InterrogationProcessor.interrogate_many, field names match the UI/process_batch arguments
+@dataclass
+class InterrogationConfig:
+    model_selection: List[str] = field(default_factory=list)
+    debug_mode: bool = False
+    prompt_weight_mode: bool = False
+    prompt_weight: float = 0.5
+    exaggeration_mode: bool = False
+    use_positive_filter: bool = False
+    use_negative_filter: bool = False
+    use_custom_filter: bool = False
+    custom_filter: str = ""
+    use_custom_replace: bool = False
+    custom_replace_find: str = ""
+    custom_replace_replacements: str = ""
+    clip_ext_model: List[str] = field(default_factory=lambda: ['ViT-L-14/openai'])
+    clip_ext_mode: str = "best"
+    wd_ext_model: List[str] = field(default_factory=list)
+    wd_threshold: float = 0.35
+    wd_underscore_fix: bool = True
+    wd_append_ratings: bool = False
+    wd_ratings: float = 0.5
+    wd_keep_tags: str = ""
+    unload_clip_models_afterwords: bool = True
+    unload_wd_models_afterwords: bool = True
+    no_puncuation_mode: bool = False
+    # Longest image side handed to the interrogators, 0 keeps the full resolution
+    max_image_side: int = 1024
+    # interrogate_many decodes and interrogates this many images at a time
+    stream_chunk_size: int = 32
+    # Run the cheap taggers before the CLIP models (see interrogator_tiers), interrogate_many does so over all images
+    cheap_first: bool = True
+    # Seconds each model may spend per job (see ModelTimeBudget), None uses the WebUI setting
+    model_time_budgets: Optional[Dict[str, float]] = None
+    # Seconds per image each model may take before its call is abandoned (see ModelTimeouts), and what replaces the
+    # result then: "skip", "cached" or "cheaper". None uses the WebUI settings
+    model_timeouts: Optional[Dict[str, float]] = None
+    timeout_fallback: Optional[str] = None
+    # Tag deduplication, see TagAssembly.assemble
+    assembly_policy: str = "keep-first"
+    model_priority: List[str] = field(default_factory=list)
+    max_tags: int = 0
+    # Used by the positive/negative duplicate filters
+    prompt: str = ""
+    negative_prompt: str = ""
+
+# Per-image result of InterrogationProcessor.interrogate_many
+@dataclass
+class ImageInterrogation:
+    # Interrogator output joined in model order, before any filtering
+    raw: str = ""
+    # Interrogation after dedup, find & replace, filters and weighting
+    interrogation: str = ""
+    # WD ratings of the last WD model that ran
+    ratings: Dict[str, float] = field(default_factory=dict)
+    # Models (and confidences) behind each tag of the interrogation, see TagAssembly.provenance
+    provenance: Dict[str, Any] = field(default_factory=dict)
+
+# Raised by InterrogationProcessor.interrogate_many when the job is interrupted before every image was interrogated
+class InterrogationInterrupted(Exception):
+    pass
+
+# Orderings TagAssembly.assemble can put the deduplicated tags in
+assembly_policies = ("keep-first", "highest-confidence", "model-priority")
+# "(tag:0.95)", as Deepbooru writes tags with "interrogate_return_ranks" on
+ranked_tag_pattern = re.compile(r"^\((.+):(\d+(?:\.\d+)?)\)$")
+
+# One distinct tag of an interrogation: the models that produced it, with their confidences (None where the model
+# reports none), and the position of its first appearance in the raw interrogation
+@dataclass
+class TagProvenance:
+    tag: str
+    position: int
+    models: List[str] = field(default_factory=list)
+    confidences: List[Optional[float]] = field(default_factory=list)
+    
+    @property
+    def confidence(self):
+        known = [confidence for confidence in self.confidences if confidence is not None]
+        return max(known) if known else None
+
+# The interrogation of one image as distinct tags with their provenance. `raw` keeps the model outputs joined in
+# selection order, as the interrogation string was built before; tags are split only once, when a model output is added.
+class TagAssembly:
+    def __init__(self):
+        self.raw = ""
+        # Tag -> TagProvenance, in order of first appearance
+        self.tags = {}
+        # Model label -> model_selection entry, so priorities can name either
+        self.families = {}
+        self.count = 0
+    
+    # Assembly of a raw interrogation string whose models are unknown
+    @classmethod
+    def parse(cls, raw):
+        assembly = cls()
+        assembly.add(None, raw)
+        assembly.raw = raw
+        return assembly
+    
+    # Adds one model output, `confidences` maps its tags to the model confidence where the model reports one
+    def add(self, model, interrogation, confidences=None, family=None):
+        self.raw += f"{interrogation}, "
+        self.families[model] = family or model
+        for item in interrogation.split(','):
+            tag = item.strip()
+            if not tag:
+                continue
+            confidence = confidences.get(tag) if confidences else None
+            if confidence is None:
+                match = ranked_tag_pattern.match(tag)
+                if match:
+                    confidence = float(match.group(2))
+            provenance = self.tags.get(tag)
+            if provenance is None:
+                provenance = self.tags[tag] = TagProvenance(tag, self.count)
+            provenance.models.append(model)
+            provenance.confidences.append(confidence)
+            self.count += 1
+    
+    # Deduplicated tags as an interrogation string, in one pass over the distinct tags. keep-first keeps the order of
+    # first appearance (the former string dedup), highest-confidence puts the most confident tags first (tags without
+    # any confidence last) and model-priority orders by the first model of `model_priority` (labels or model_selection
+    # entries) that produced the tag. Ties keep the order of first appearance, `max_tags` > 0 keeps only the first tags.
+    def assemble(self, policy="keep-first", model_priority=None, max_tags=0):
+        ordered = list(self.tags.values())
+        if policy == "highest-confidence":
+            ordered.sort(key=lambda provenance: (provenance.confidence is None, -(provenance.confidence or 0.0)))
+        elif policy == "model-priority":
+            ranks = {model: rank for rank, model in enumerate(model_priority or [])}
+            def model_rank(model):
+                return ranks.get(model, ranks.get(self.families.get(model), len(ranks)))
+            ordered.sort(key=lambda provenance: min(model_rank(model) for model in provenance.models))
+        elif policy != "keep-first":
+            raise ValueError(f"Unknown assembly policy '{policy}', expected one of {', '.join(assembly_policies)}")
+        if max_tags > 0:
+            ordered = ordered[:max_tags]
+        return ", ".join(provenance.tag for provenance in ordered)
+    
+    # Compact provenance of the tags present in `interrogation` (all tags if None): {"models": [labels],
+    # "tags": {tag: [model index or [model index, confidence], ...]}}
+    def provenance(self, interrogation=None):
+        present = None if interrogation is None else {item.strip() for item in interrogation.split(',')}
+        models = []
+        tags = {}
+        for provenance in self.tags.values():
+            if present is not None and provenance.tag not in present:
+                continue
+            entries = []
+            for model, confidence in zip(provenance.models, provenance.confidences):
+                if model not in models:
+                    models.append(model)
+                index = models.index(model)
+                entries.append(index if confidence is None else [index, round(confidence, 4)])
+            tags[provenance.tag] = entries
+        return {"models": models, "tags": tags}
+
+# Relative cost of the interrogators. Lower tiers run first, so when a job is interrupted or runs out of time the
+# cheap taggers have already captioned every image. CLIP (EXT) is tiered by mode, by how much it ranks per image.
+interrogator_tiers = {"Deepbooru (Native)": 0, "Deepbooru (ONNX)": 0, "WD (EXT)": 0, "CLIP (Native)": 2}
+clip_ext_mode_tiers = {"fast": 1, "classic": 2, "negative": 2, "best": 3}
+
+# Interrogators added by other extensions, name -> (batch_fn, tier). They are offered in model_selection next to the
+# built-in ones, batch_fn receives a list of RGB images and returns one interrogation string per image.
+custom_interrogators = {}
+
+def register_interrogator(name, batch_fn, tier=1):
+    if name in interrogator_tiers:
+        raise ValueError(f"'{name}' is a built-in interrogator")
+    custom_interrogators[name] = (batch_fn, tier)
+
+def unregister_interrogator(name):
+    custom_interrogators.pop(name, None)
+
+# One interrogator model of a job, see InterrogationProcessor.interrogation_passes
+@dataclass
+class InterrogationPass:
+    # Model label, e.g. "CLIP (ViT-L-14/openai:best)" or "WD (WD14 ViT v2)"
+    label: str
+    # Entry of model_selection the pass belongs to, e.g. "CLIP (EXT)"
+    model: str
+    run: Any
+    tier: Optional[int] = None
+    # Cheaper pass used when this one times out, see ModelTimeouts
+    fallback: Optional["InterrogationPass"] = None
+    # Loaded model the pass runs on, e.g. every CLIP (EXT) mode and model shares the one clip-interrogator instance.
+    # Defaults to the label
+    resource: Optional[str] = None
+    # Frees the model when the config asks to unload it after use. run() never unloads, callers do so once after all
+    # their images (see InterrogationProcessor.unload_passes)
+    unload: Optional[Callable[[], Any]] = None
+    
+    def __post_init__(self):
+        if self.tier is None:
+            self.tier = interrogator_tiers.get(self.model, 3)
+        if self.resource is None:
+            self.resource = self.label
+
+# Parses the "label=seconds, label=seconds" format of the time budget and timeout settings
+def parse_model_seconds(text):
+    values = {}
+    for entry in (text or "").split(","):
+        if not entry.strip():
+            continue
+        label, separator, seconds = entry.rpartition("=")
+        try:
+            if not separator:
+                raise ValueError("missing '='")
+            values[label.strip()] = float(seconds)
+        except ValueError as error:
+            print(f"[{NAME} ERROR]: Ignoring '{entry.strip()}': {error}")
+    return values
+
+# Entry of a label -> seconds mapping that applies to a pass, its own label first, then its model_selection entry
+def model_seconds_key(values, interrogation_pass):
+    for label in (interrogation_pass.label, interrogation_pass.model):
+        if label in values:
+            return label
+    return None
+
+# Time budgets, in seconds, the interrogators may spend over one img2img batch or interrogate_many call.
+# Budgets are keyed by model label or by model_selection entry (covering all its models), a model whose budget
+# is spent is skipped for the rest of the job. A running model batch is never cut short.
+class ModelTimeBudget:
+    def __init__(self, budgets=None):
+        self.budgets = {label: float(seconds) for label, seconds in (budgets or {}).items()}
+        self.spent = {}
+        # Images each model was skipped for
+        self.skipped = Counter()
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def from_config(cls, config):
+        if config.model_time_budgets is not None:
+            return cls(config.model_time_budgets)
+        return cls(parse_model_seconds(getattr(shared.opts, "img2img_batch_interrogator_model_budgets", "")))
+    
+    def key(self, interrogation_pass):
+        return model_seconds_key(self.budgets, interrogation_pass)
+    
+    # Whether the pass may run, counts the images it is skipped for otherwise
+    def allows(self, interrogation_pass, image_count=1):
+        key = self.key(interrogation_pass)
+        with self.lock:
+            if key is None or self.spent.get(key, 0.0) < self.budgets[key]:
+                return True
+            if not self.skipped[interrogation_pass.label]:
+                print(f"[{NAME}]: Time budget of {key} ({self.budgets[key]:g}s) spent, skipping {interrogation_pass.label} for the rest of the job.")
+            self.skipped[interrogation_pass.label] += image_count
+        return False
+    
+    def charge(self, interrogation_pass, seconds):
+        key = self.key(interrogation_pass)
+        if key is not None:
+            with self.lock:
+                self.spent[key] = self.spent.get(key, 0.0) + seconds
+
+# Time a timed pass (see ModelTimeouts) spends running its model, waiting in the scheduler queue is not counted.
+# The pass's worker thread sets itself as `model_call_clocks.current`, the scheduler runs the batches of the pass
+# inside running(), on the dispatcher or, with the scheduler off, on the worker thread itself.
+model_call_clocks = threading.local()
+
+class ModelCallClock:
+    def __init__(self):
+        self.spent = 0.0
+        self.started = None
+        # Thread running a batch of the call, None while it waits
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    @contextlib.contextmanager
+    def running(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.thread = threading.current_thread()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.spent += time.monotonic() - self.started
+                self.started = None
+                self.thread = None
+    
+    def elapsed(self):
+        with self.lock:
+            return self.spent + (time.monotonic() - self.started if self.started is not None else 0.0)
+
+# Collects interrogation requests for the same model from concurrent callers over a short window and runs
+# them as one batch on a single dispatcher thread, resolving each caller's future with its own result.
+# Requests are keyed by model (and model options), batch_fn receives a list of images and returns one result per image.
+# The first key entry names the loaded model ("CLIP (EXT)", "WD (EXT)", ...), see abandon_dispatcher.
+class MicroBatchScheduler:
+    def __init__(self, max_batch=8, max_wait_ms=25):
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.dispatcher = None
+        # Dispatcher thread -> key of the batch it is running
+        self.running = {}
+        # key[0] -> abandoned dispatcher still running a batch of that model
+        self.stuck = {}
+    
+    # Batch limits can be changed from the WebUI settings while running
+    def limits(self):
+        max_batch = getattr(shared.opts, "img2img_batch_interrogator_max_batch", self.max_batch)
+        max_wait_ms = getattr(shared.opts, "img2img_batch_interrogator_max_wait_ms", self.max_wait_ms)
+        return max(1, int(max_batch)), max(0.0, float(max_wait_ms)) / 1000.0
+    
+    def submit(self, key, batch_fn, image):
+        future = Future()
+        with self.condition:
+            self.pending.setdefault(key, []).append((time.monotonic(), batch_fn, image, future, getattr(model_call_clocks, "current", None)))
+            self.ensure_dispatcher()
+            self.condition.notify_all()
+        return future
+    
+    # Starts a dispatcher thread when none is running, called with the condition held
+    def ensure_dispatcher(self):
+        if self.dispatcher is None or not self.dispatcher.is_alive():
+            self.dispatcher = threading.Thread(target=self.run, name=f"{NAME} scheduler", daemon=True)
+            self.dispatcher.start()
+    
+    # Leaves a dispatcher stuck in a hung batch behind and starts a new one for the requests already queued, later
+    # submits start one otherwise. Only `thread` (default: the current dispatcher) is abandoned, and only while it is
+    # the dispatcher. Batches for the hung model wait until its batch returns, the new dispatcher runs the others;
+    # the old dispatcher exits once its batch returns.
+    def abandon_dispatcher(self, thread=None):
+        with self.condition:
+            if self.dispatcher is None or (thread is not None and thread is not self.dispatcher):
+                return
+            key = self.running.get(self.dispatcher)
+            if key is not None:
+                self.stuck[key[0]] = self.dispatcher
+            self.dispatcher = None
+            if self.pending:
+                self.ensure_dispatcher()
+    
+    # Returns the key of a batch that is full or has waited long enough, otherwise the seconds until the next deadline
+    def next_ready(self):
+        max_batch, max_wait = self.limits()
+        now = time.monotonic()
+        next_deadline = None
+        for key, items in self.pending.items():
+            if key[0] in self.stuck:
+                continue
+            deadline = items[0][0] + max_wait
+            if len(items) >= max_batch or deadline <= now:
+                return key, max_batch
+            next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+        return None, next_deadline - now if next_deadline is not None else None
+    
+    def run(self):
+        while True:
+            with self.condition:
+                if self.dispatcher is not threading.current_thread():
+                    return
+                key, value = self.next_ready()
+                while key is None:
+                    self.condition.wait(timeout=value)
+                    if self.dispatcher is not threading.current_thread():
+                        return
+                    key, value = self.next_ready()
+                items = self.pending[key][:value]
+                del self.pending[key][:value]
+                if not self.pending[key]:
+                    del self.pending[key]
+                self.running[threading.current_thread()] = key
+            
+            batch_fn = items[0][1]
+            images = [item[2] for item in items]
+            try:
+                with contextlib.ExitStack() as clocks:
+                    for clock in {id(item[4]): item[4] for item in items if item[4] is not None}.values():
+                        clocks.enter_context(clock.running())
+                    results = batch_fn(images)
+                if len(results) != len(items):
+                    raise RuntimeError(f"Batch returned {len(results)} results for {len(items)} images")
+                for item, result in zip(items, results):
+                    item[3].set_result(result)
+            except Exception as error:
+                for item in items:
+                    if not item[3].done():
+                        item[3].set_exception(error)
+            finally:
+                with self.condition:
+                    del self.running[threading.current_thread()]
+                    if self.stuck.get(key[0]) is threading.current_thread():
+                        del self.stuck[key[0]]
+                        self.condition.notify_all()
+
+interrogation_scheduler = MicroBatchScheduler()
+
+# Per-model timeouts. A pass with a timeout runs on its own worker thread and is abandoned when it takes longer than
+# its timeout per image; Python threads can not be killed, so a loaded model (InterrogationPass.resource) whose
+# abandoned call is still running is not called again, by any pass, until that call returns. Results are kept per
+# image so the "cached" fallback can reuse them.
+timeout_fallbacks = ("skip", "cached", "cheaper")
+
+class ModelTimeouts:
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        # Pass resource -> Future of an abandoned call that is still running
+        self.abandoned = {}
+        # (pass label, image hash) -> result
+        self.results = OrderedDict()
+        # Images each model timed out on since startup
+        self.timeouts = Counter()
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def settings(config):
+        timeouts = config.model_timeouts
+        if timeouts is None:
+            timeouts = parse_model_seconds(getattr(shared.opts, "img2img_batch_interrogator_model_timeouts", ""))
+        fallback = config.timeout_fallback or getattr(shared.opts, "img2img_batch_interrogator_timeout_fallback", "skip")
+        if fallback not in timeout_fallbacks:
+            raise ValueError(f"Unknown timeout fallback '{fallback}', expected one of {', '.join(timeout_fallbacks)}")
+        return timeouts, fallback
+    
+    # Whether an abandoned call on the resource is still running
+    def busy(self, resource):
+        with self.lock:
+            running = self.abandoned.get(resource)
+            if running is None:
+                return False
+            if not running.done():
+                return True
+            del self.abandoned[resource]
+            return False
+    
+    # Runs the pass, returns its results or None when its model ran for longer than `seconds`. Time spent queued
+    # behind other callers' batches does not count (see ModelCallClock).
+    def run(self, interrogation_pass, images, seconds):
+        future = Future()
+        clock = ModelCallClock()
+        def work():
+            model_call_clocks.current = clock
+            try:
+                future.set_result(interrogation_pass.run(images))
+            except Exception as error:
+                future.set_exception(error)
+        threading.Thread(target=work, name=f"{NAME} {interrogation_pass.label}", daemon=True).start()
+        while True:
+            try:
+                return future.result(timeout=max(0.0, seconds - clock.elapsed()))
+            except FutureTimeoutError:
+                if clock.elapsed() >= seconds:
+                    break
+        with self.lock:
+            self.abandoned[interrogation_pass.resource] = future
+        # The scheduler dispatcher may be the thread that hangs, it is left behind only if it runs this call
+        hung_thread = clock.thread
+        if hung_thread is not None:
+            interrogation_scheduler.abandon_dispatcher(hung_thread)
+        return None
+    
+    def remember(self, label, hashes, results):
+        with self.lock:
+            for hash_value, result in zip(hashes, results):
+                if result[0] is not None:
+                    self.results[(label, hash_value)] = result
+                    self.results.move_to_end((label, hash_value))
+            while len(self.results) > self.cache_size:
+                self.results.popitem(last=False)
+    
+    def cached(self, label, hashes):
+        with self.lock:
+            return [self.results.get((label, hash_value), (None, None, None)) for hash_value in hashes]
+
+model_timeouts = ModelTimeouts()
+
+# Loads the selected interrogators on a background thread before they are needed, so the first image of a batch
+# does not pay for model loading. Loads never overlap an interrogation: an interrogation waits for the load in
+# progress and drops the loads still pending, since it loads whatever it needs itself.
+class InterrogatorWarmup:
+    def __init__(self):
+        # key -> (label, load_fn), in request order
+        self.pending = {}
+        self.loading = None
+        self.interrogations = 0
+        self.condition = threading.Condition()
+        self.worker = None
+    
+    # Replaces the pending loads with `loads`, (key, label, load_fn) tuples. Load functions return early for models
+    # that are already resident.
+    def request(self, loads):
+        with self.condition:
+            self.pending = {key: (label, load_fn) for key, label, load_fn in loads if key != self.loading}
+            if self.pending and (self.worker is None or not self.worker.is_alive()):
+                self.worker = threading.Thread(target=self.run, name=f"{NAME} warmup", daemon=True)
+                self.worker.start()
+            self.condition.notify_all()
+    
+    # Context manager around an interrogation
+    @contextlib.contextmanager
+    def interrogating(self):
+        with self.condition:
+            self.pending.clear()
+            while self.loading is not None:
+                self.condition.wait()
+            self.interrogations += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.interrogations -= 1
+                self.condition.notify_all()
+    
+    # Blocks until no load is pending or running, mostly for callers that want resident models before timing something
+    def wait(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and self.loading is None, timeout)
+    
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending or self.interrogations:
+                    self.condition.wait()
+                key = next(iter(self.pending))
+                label, load_fn = self.pending.pop(key)
+                self.loading = key
+            start = time.perf_counter()
+            try:
+                load_fn()
+                print(f"[{NAME}]: Warmed up {label} in {time.perf_counter() - start:.1f}s")
+            except Exception as error:
+                print(f"[{NAME} ERROR]: Could not warm up {label}: {error}")
+            finally:
+                with self.condition:
+                    self.loading = None
+                    self.condition.notify_all()
+
+interrogator_warmup = InterrogatorWarmup()
+
+# Top `top_count` (row indices, scores) per query for a (N, D) float32 array of normalized queries against a
+# (possibly memory-mapped) (M, D) embedding matrix, walked in chunks so only one chunk is ever in RAM as float32
+def top_k_rows(features, embeds, top_count, chunk_rows=16384):
+    top_count = min(top_count, len(embeds))
+    best_scores = np.empty((len(features), 0), dtype=np.float32)
+    best_rows = np.empty((len(features), 0), dtype=np.int64)
+    for start in range(0, len(embeds), chunk_rows):
+        chunk = np.asarray(embeds[start:start + chunk_rows], dtype=np.float32)
+        scores = np.concatenate([best_scores, features @ chunk.T], axis=1)
+        rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(chunk)), (len(features), len(chunk)))], axis=1)
+        keep_count = min(top_count, scores.shape[1])
+        keep = np.argpartition(-scores, keep_count - 1, axis=1)[:, :keep_count]
+        best_scores = np.take_along_axis(scores, keep, axis=1)
+        best_rows = np.take_along_axis(rows, keep, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+# Disk cache of the clip-interrogator label tables (mediums, artists, trendings, movements, flavors) per CLIP model.
+# Text embeddings are stored once as float16 .npy files and memory-mapped, ranking is a matrix multiply over a
+# whole batch of image embeddings (see top_k_rows).
+class ClipFlavorCache:
+    table_names = ("mediums", "artists", "trendings", "movements", "flavors")
+    chunk_rows = 16384
+    
+    def __init__(self, cache_dir="models/clip-interrogator/flavor_cache"):
+        self.cache_dir = cache_dir
+        self.tables = {}
+    
+    # Returns (labels, memory-mapped embeddings) for one label table of the loaded clip-interrogator
+    def table(self, ci, clip_model, table_name):
+        label_table = getattr(ci, table_name)
+        labels = label_table.labels
+        cached = self.tables.get((clip_model, table_name))
+        if cached is not None and cached[0] is labels:
+            return cached
+        
+        # The label list is part of the file name so edited label files never reuse stale embeddings
+        digest = hashlib.sha1("\n".join(labels).encode("utf-8")).hexdigest()[:16]
+        model_dir = os.path.join(self.cache_dir, re.sub(r"[^\w.-]", "_", clip_model))
+        path = os.path.join(model_dir, f"{table_name}_{digest}.npy")
+        if not os.path.exists(path):
+            os.makedirs(model_dir, exist_ok=True)
+            embeds = np.stack([np.asarray(embed, dtype=np.float16).reshape(-1) for embed in label_table.embeds])
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as file:
+                np.save(file, embeds)
+            os.replace(temp_path, path)
+            print(f"[{NAME}]: Cached {len(labels)} {table_name} embeddings for {clip_model}.")
+        
+        cached = (labels, np.load(path, mmap_mode="r"))
+        self.tables[(clip_model, table_name)] = cached
+        return cached
+    
+    # Ranked labels per image for one table
+    def rank(self, ci, clip_model, table_name, features, top_count):
+        labels, embeds = self.table(ci, clip_model, table_name)
+        rows, _ = top_k_rows(features, embeds, top_count, self.chunk_rows)
+        return [[labels[row] for row in image_rows] for image_rows in rows]
+    
+    # Ranked labels per image over all tables combined, same as clip-interrogator's merged table used by `fast`
+    def rank_merged(self, ci, clip_model, features, top_count):
+        candidates = [[] for _ in features]
+        for table_name in ("artists", "flavors", "mediums", "movements", "trendings"):
+            labels, embeds = self.table(ci, clip_model, table_name)
+            rows, scores = top_k_rows(features, embeds, top_count, self.chunk_rows)
+            for i in range(len(features)):
+                candidates[i].extend((score, labels[row]) for row, score in zip(rows[i], scores[i]))
+        return [[label for _, label in sorted(image_candidates, key=lambda item: -item[0])[:top_count]] for image_candidates in candidates]
+
+clip_flavor_cache = ClipFlavorCache()
+
+# Reduced-size RGB copy of an image for the interrogators. `source` is a PIL image, a path or a file object.
+# Files are opened lazily and JPEGs are decoded straight at reduced scale through Image.draft. Images larger
+# than `max_side` are downscaled before the RGB conversion, so no full resolution RGB copy is ever made.
+# Every tagger works well below 1024px, a `max_side` of 0 keeps the full resolution.
+def load_interrogation_image(source, max_side=1024):
+    if not isinstance(source, Image.Image):
+        with Image.open(source) as image:
+            if max_side:
+                image.draft("RGB", (max_side, max_side))
+            return load_interrogation_image(image, max_side)
+    
+    image = source
+    # Palette and other special modes can not be resampled directly
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGB")
+    if max_side and max(image.size) > max_side:
+        scale = max_side / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.BICUBIC, reducing_gap=3.0)
+    return image.convert("RGB")
+
+# Stable content hash of an image, used to key stored embeddings and cached results
+def image_hash(image):
+    digest = hashlib.sha1(f"{image.mode}:{image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+# Append-only store of normalized CLIP image embeddings for one CLIP model. Rows are raw float16 values in
+# `embeddings.f16`, `index.tsv` maps image hash -> row. Reads memory-map the data file, so lookups never load
+# the whole store into RAM.
+class ImageEmbeddingStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.data_path = os.path.join(store_dir, "embeddings.f16")
+        self.index_path = os.path.join(store_dir, "index.tsv")
+        self.meta_path = os.path.join(store_dir, "meta.json")
+        self.lock = threading.Lock()
+        self.dim = None
+        self.hashes = []
+        self.rows = {}
+        self.load_index()
+    
+    def load_index(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as file:
+                self.dim = json.load(file)["dim"]
+        if not self.dim:
+            return
+        data_size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        row_count = data_size // (self.dim * 2)
+        valid = True
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 2 or not parts[1].isdigit() or int(parts[1]) != len(self.hashes) or int(parts[1]) >= row_count:
+                        valid = False
+                        break
+                    self.rows[parts[0]] = len(self.hashes)
+                    self.hashes.append(parts[0])
+        # An interrupted append leaves extra data rows or index lines, cut both back to the last complete row. A crash
+        # before the first index write leaves rows without any index, later appends would be indexed past them
+        if not valid or data_size != len(self.hashes) * self.dim * 2:
+            print(f"[{NAME}]: Repairing embedding store {self.store_dir}, keeping {len(self.hashes)} rows.")
+            if os.path.exists(self.data_path):
+                with open(self.data_path, "r+b") as file:
+                    file.truncate(len(self.hashes) * self.dim * 2)
+            with open(self.index_path, "w", encoding="utf-8") as file:
+                file.writelines(f"{hash_value}\t{row}\n" for row, hash_value in enumerate(self.hashes))
+    
+    def __len__(self):
+        return len(self.hashes)
+    
+    def __contains__(self, hash_value):
+        return hash_value in self.rows
+    
+    # Appends embeddings for hashes that are not stored yet, `embeddings` is an (N, D) array
+    def add(self, hashes, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float16).reshape(len(hashes), -1)
+        with self.lock:
+            if self.dim is None:
+                os.makedirs(self.store_dir, exist_ok=True)
+                self.dim = embeddings.shape[1]
+                with open(self.meta_path, "w", encoding="utf-8") as file:
+                    json.dump({"dim": self.dim}, file)
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f"Embedding size {embeddings.shape[1]} does not match store size {self.dim}")
+            
+            new_rows = []
+            for hash_value, embedding in zip(hashes, embeddings):
+                if hash_value not in self.rows:
+                    self.rows[hash_value] = len(self.hashes)
+                    self.hashes.append(hash_value)
+                    new_rows.append((hash_value, embedding))
+            if not new_rows:
+                return
+            # Data is written before the index so an index entry never points past the data file
+            with open(self.data_path, "ab") as file:
+                file.write(np.stack([embedding for _, embedding in new_rows]).tobytes())
+            with open(self.index_path, "a", encoding="utf-8") as file:
+                file.writelines(f"{hash_value}\t{self.rows[hash_value]}\n" for hash_value, _ in new_rows)
+    
+    # Memory-mapped (rows, dim) view of the stored embeddings
+    def embeddings(self):
+        if not self.hashes:
+            return np.empty((0, self.dim or 0), dtype=np.float16)
+        return np.memmap(self.data_path, dtype=np.float16, mode="r", shape=(len(self.hashes), self.dim))
+    
+    def get(self, hash_value):
+        row = self.rows.get(hash_value)
+        return None if row is None else np.asarray(self.embeddings()[row], dtype=np.float32)
+    
+    # The `count` most similar stored images as (hash, cosine similarity) per query embedding
+    def nearest(self, embeddings, count=5):
+        if not self.hashes:
+            return [[] for _ in embeddings]
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        rows, scores = top_k_rows(queries, self.embeddings(), count)
+        return [[(self.hashes[row], float(score)) for row, score in zip(query_rows, query_scores)] for query_rows, query_scores in zip(rows, scores)]
+
+# One embedding store per CLIP model, opened on first use
+embedding_stores = {}
+embedding_stores_lock = threading.Lock()
+
+def get_embedding_store(clip_model):
+    with embedding_stores_lock:
+        if clip_model not in embedding_stores:
+            store_dir = os.path.join("extensions/sd-Img2img-batch-interrogator/embeddings", re.sub(r"[^\w.-]", "_", clip_model))
+            embedding_stores[clip_model] = ImageEmbeddingStore(store_dir)
+        return embedding_stores[clip_model]
+
+# Deepbooru exported once to ONNX (optionally int8 dynamic-quantized) and run batched on the CPU with onnxruntime.
+# Preprocessing and tag formatting follow modules.deepbooru so results are comparable with "Deepbooru (Native)".
+class DeepbooruOnnx:
+    model_dir = "models/torch_deepdanbooru"
+    chunk_size = 16
+    
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def is_available():
+        return importlib.util.find_spec("onnxruntime") is not None
+    
+    def model_path(self, quantize):
+        return os.path.join(self.model_dir, "model-resnet_custom_v3-int8.onnx" if quantize else "model-resnet_custom_v3.onnx")
+    
+    # Exports the native model (NHWC float32 input, dynamic batch) and quantizes it if needed
+    def export(self, quantize):
+        import copy
+        import torch
+        fp32_path = self.model_path(False)
+        tags_path = f"{fp32_path}.tags.json"
+        if not os.path.exists(fp32_path) or not os.path.exists(tags_path):
+            print(f"[{NAME}]: Exporting Deepbooru to ONNX, this only happens once...")
+            deepbooru.model.load()
+            model = copy.deepcopy(deepbooru.model.model).to("cpu", torch.float32).eval()
+            temp_path = f"{fp32_path}.{os.getpid()}.tmp"
+            # Newer torch defaults to the dynamo exporter, which needs onnxscript; the TorchScript one is enough here
+            export_options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+            with torch.no_grad():
+                torch.onnx.export(
+                    model, torch.zeros(1, 512, 512, 3), temp_path, input_names=["image"], output_names=["probabilities"],
+                    dynamic_axes={"image": {0: "batch"}, "probabilities": {0: "batch"}}, opset_version=14, **export_options
+                )
+            # Keep the tag list next to the export so inference never needs the torch model. It is in place before
+            # the model is, so an export that exists always has its tags
+            temp_tags_path = f"{tags_path}.{os.getpid()}.tmp"
+            with open(temp_tags_path, "w", encoding="utf-8") as file:
+                json.dump(list(deepbooru.model.model.tags), file)
+            os.replace(temp_tags_path, tags_path)
+            os.replace(temp_path, fp32_path)
+        if quantize and not os.path.exists(self.model_path(True)):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            print(f"[{NAME}]: Quantizing ONNX Deepbooru to int8...")
+            temp_path = f"{self.model_path(True)}.{os.getpid()}.tmp"
+            quantize_dynamic(fp32_path, temp_path, weight_type=QuantType.QInt8)
+            os.replace(temp_path, self.model_path(True))
+    
+    # Returns (session, tags), exporting on first use
+    def session(self, quantize):
+        with self.lock:
+            if quantize not in self.sessions:
+                import onnxruntime
+                self.export(quantize)
+                with open(f"{self.model_path(False)}.tags.json", "r", encoding="utf-8") as file:
+                    tags = json.load(file)
+                session = onnxruntime.InferenceSession(self.model_path(quantize), providers=["CPUExecutionProvider"])
+                self.sessions[quantize] = (session, tags)
+            return self.sessions[quantize]
+    
+    # Tag probabilities as an (N, tags) array
+    def probabilities(self, images, quantize):
+        from modules import images as sd_images
+        session, tags = self.session(quantize)
+        input_name = session.get_inputs()[0].name
+        outputs = []
+        for start in range(0, len(images), self.chunk_size):
+            batch = np.stack([np.array(sd_images.resize_image(2, image.convert("RGB"), 512, 512), dtype=np.float32) / 255 for image in images[start:start + self.chunk_size]])
+            outputs.append(session.run(None, {input_name: batch})[0])
+        return np.concatenate(outputs), tags
+    
+    # Same thresholds, ordering, filtering and formatting options as DeepDanbooru.tag_multi
+    def format_tags(self, probabilities, tags):
+        threshold = shared.opts.interrogate_deepbooru_score_threshold
+        probability_dict = {tag: probability for tag, probability in zip(tags, probabilities) if probability >= threshold and not tag.startswith("rating:")}
+        if shared.opts.deepbooru_sort_alpha:
+            sorted_tags = sorted(probability_dict)
+        else:
+            sorted_tags = [tag for tag, _ in sorted(probability_dict.items(), key=lambda x: -x[1])]
+        filter_tags = {x.strip().replace(' ', '_') for x in shared.opts.deepbooru_filter_tags.split(",")}
+        res = []
+        for tag in [x for x in sorted_tags if x not in filter_tags]:
+            tag_outformat = tag
+            if shared.opts.deepbooru_use_spaces:
+                tag_outformat = tag_outformat.replace('_', ' ')
+            if shared.opts.deepbooru_escape:
+                tag_outformat = re.sub(deepbooru.re_special, r'\\\1', tag_outformat)
+            if shared.opts.interrogate_return_ranks:
+                tag_outformat = f"({tag_outformat}:{probability_dict[tag]:.3f})"
+            res.append(tag_outformat)
+        return ", ".join(res)
+    
+    def tag_batch(self, images, quantize):
+        probabilities, tags = self.probabilities(images, quantize)
+        return [self.format_tags(row, tags) for row in probabilities]
+
+deepbooru_onnx = DeepbooruOnnx()
+
+# Base prompt parsed once for "Insert at index": comma separated parts (same split as the insert index has always
+# used), the attention depth each part starts at, and whether it touches a LoRA/extra-network <...> span.
+# Depth is tracked across commas so nested groups like "((a, b), c:1.2)" are labelled correctly.
+class ParsedPrompt:
+    def __init__(self, text):
+        parts, depths, labels = [], [], []
+        depth = 0
+        in_network = False
+        for raw_part in text.split(','):
+            part = raw_part.strip()
+            start_depth, start_network = depth, in_network
+            touches_network, has_brackets = in_network, False
+            escaped = False
+            for char in raw_part:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == "<":
+                    in_network = touches_network = True
+                elif char == ">":
+                    in_network = False
+                elif char in "([":
+                    depth += 1
+                    has_brackets = True
+                elif char in ")]":
+                    depth = max(0, depth - 1)
+                    has_brackets = True
+            if not part:
+                continue
+            label = None
+            if touches_network or start_network:
+                label = "lora"
+            elif start_depth > 0 or has_brackets or re.search(r":\d", part):
+                label = "attention"
+            parts.append(part)
+            depths.append(start_depth)
+            labels.append(label)
+        
+        self.parts = tuple(parts)
+        self.depths = tuple(depths)
+        self.labels = tuple(labels)
+        self.joined = ", ".join(parts)
+        # Character offset of every part in `joined`, plus the end, so a splice is two slices
+        offsets = []
+        offset = 0
+        for part in parts:
+            offsets.append(offset)
+            offset += len(part) + 2
+        offsets.append(len(self.joined))
+        self.offsets = tuple(offsets)
+    
+    def __len__(self):
+        return len(self.parts)
+    
+    def clamp_index(self, index):
+        try:
+            idx = int(index)
+        except Exception:
+            idx = 0
+        return max(0, min(idx, len(self.parts)))
+    
+    # Same result as ", ".join(parts[:idx] + [text] + parts[idx:])
+    def splice(self, index, text):
+        idx = self.clamp_index(index)
+        if not self.parts:
+            return text
+        if idx == len(self.parts):
+            return f"{self.joined}, {text}"
+        return f"{self.joined[:self.offsets[idx]]}{text}, {self.joined[self.offsets[idx]:]}"
+    
+    # (part, label) pairs for the insertion preview with the insert marker at `index`
+    def highlights(self, index):
+        highlights = list(zip(self.parts, self.labels))
+        highlights.insert(self.clamp_index(index), ("<interrogation>", "insert"))
+        return highlights
+
+# Parsed prompts are cached by text, the preview and every image of a batch share the same parse
+@functools.lru_cache(maxsize=64)
+def parse_prompt(text):
+    return ParsedPrompt(text or "")
+
+# Sharded interrogation of an image folder across several WebUI nodes. Images are assigned to shards by a hash
+# of their path relative to the input folder, so every node computes the same split without talking to the
+# others. Each shard appends its results to its own JSONL file in a shared output folder and writes a `.done`
+# marker when finished, merge_shards combines the shard files into one manifest.
+image_extensions = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff", ".avif")
+
+def shard_for(key, shard_count):
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:16], 16) % shard_count
+
+def shard_file_name(shard_index, shard_count):
+    return f"shard-{shard_index:04d}-of-{shard_count:04d}.jsonl"
+
+# Relative (posix) paths of the images of one shard, in a stable order
+def list_shard_images(input_dir, shard_index, shard_count):
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for file_name in sorted(files):
+            if file_name.lower().endswith(image_extensions):
+                relative_path = os.path.relpath(os.path.join(root, file_name), input_dir).replace(os.sep, "/")
+                if shard_for(relative_path, shard_count) == shard_index:
+                    paths.append(relative_path)
+    return paths
+
+# Paths already written to a shard file, a partial last line from an interrupted run is dropped
+def read_shard_results(shard_path):
+    results = {}
+    if os.path.exists(shard_path):
+        with open(shard_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                results[entry["path"]] = entry
+    return results
+
+# Per-shard progress read from the shared output folder
+def shard_status(output_dir):
+    shards = []
+    for file_name in sorted(os.listdir(output_dir)) if os.path.isdir(output_dir) else []:
+        match = re.fullmatch(r"shard-(\d+)-of-(\d+)\.jsonl", file_name)
+        if match:
+            shard_path = os.path.join(output_dir, file_name)
+            shards.append({
+                "shard_index": int(match.group(1)),
+                "shard_count": int(match.group(2)),
+                "completed": len(read_shard_results(shard_path)),
+                "done": os.path.exists(f"{shard_path}.done"),
+            })
+    return shards
+
+# Combines all shard files of `output_dir` into `manifest.jsonl` sorted by path
+def merge_shards(output_dir, require_complete=True):
+    shards = shard_status(output_dir)
+    shard_counts = {shard["shard_count"] for shard in shards}
+    if len(shard_counts) != 1:
+        raise ValueError(f"Expected shard files of one shard count in {output_dir}, found {sorted(shard_counts) or 'none'}")
+    shard_count = shard_counts.pop()
+    missing = sorted(set(range(shard_count)) - {shard["shard_index"] for shard in shards if shard["done"]})
+    if missing and require_complete:
+        raise ValueError(f"Shards not finished: {missing}")
+    
+    # One shard in memory at a time: each shard is written sorted by path to a run file, then the runs are merged
+    # into the manifest in one pass. Only the paths are kept across shards, a path is written once.
+    manifest_path = os.path.join(output_dir, "manifest.jsonl")
+    temp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    seen = set()
+    run_paths = []
+    try:
+        for shard in shards:
+            results = read_shard_results(os.path.join(output_dir, shard_file_name(shard["shard_index"], shard_count)))
+            run_path = f"{temp_path}.{shard['shard_index']}"
+            run_paths.append(run_path)
+            with open(run_path, "w", encoding="utf-8") as file:
+                for path in sorted(results):
+                    if path not in seen:
+                        seen.add(path)
+                        file.write(json.dumps(results[path]) + "\n")
+        with contextlib.ExitStack() as stack:
+            runs = [((json.loads(line)["path"], line) for line in stack.enter_context(open(run_path, "r", encoding="utf-8"))) for run_path in run_paths]
+            with open(temp_path, "w", encoding="utf-8") as file:
+                for _, line in heapq.merge(*runs):
+                    file.write(line)
+        os.replace(temp_path, manifest_path)
+    finally:
+        for path in run_paths + [temp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    print(f"[{NAME}]: Merged {len(seen)} results from {shard_count} shards into {manifest_path}")
+    return {"manifest": manifest_path, "images": len(seen), "shard_count": shard_count, "missing_shards": missing}
+
+# Streaming tag counters for one batch: how often each tag was produced (per model and overall), how many
+# tags each filter stage removed, how often each WD keep tag rescued a tag below the threshold, and what ended
+# up in the final interrogations. Dumped as JSON at the end of a batch together with filter suggestions.
+class TagStatistics:
+    def __init__(self):
+        self.images = 0
+        self.model_tags = {}
+        self.interrogated_tags = Counter()
+        self.filtered_tags = {}
+        self.keep_tags_fired = Counter()
+        self.final_tags = Counter()
+        # Images each model timed out on, and the fallbacks used for them
+        self.timeouts = Counter()
+        self.timeout_fallbacks = Counter()
+    
+    @staticmethod
+    def split_tags(text):
+        return [tag.strip() for tag in text.split(",") if tag.strip()]
+    
+    def record_model(self, model, text):
+        tags = self.split_tags(text)
+        self.model_tags.setdefault(model, Counter()).update(tags)
+        self.interrogated_tags.update(tags)
+    
+    def record_keep_tag(self, tag):
+        self.keep_tags_fired[tag] += 1
+    
+    def record_timeout(self, model, image_count, fallback):
+        self.timeouts[model] += image_count
+        self.timeout_fallbacks[f"{model}: {fallback}"] += image_count
+    
+    # Counts the tags a filter stage removed from `before` to get `after`
+    def record_filter(self, stage, before, after):
+        removed = Counter(self.split_tags(before)) - Counter(self.split_tags(after))
+        if removed:
+            self.filtered_tags.setdefault(stage, Counter()).update(removed)
+    
+    def record_final(self, text):
+        self.images += 1
+        self.final_tags.update(self.split_tags(text))
+    
+    # Tags that end up in at least `min_share` of the images carry little information about any single image,
+    # these are suggested for the custom filter, most frequent first
+    def suggest_filter(self, min_share=0.5, limit=25):
+        if self.images == 0:
+            return []
+        return [tag for tag, count in self.final_tags.most_common() if count / self.images >= min_share][:limit]
+    
+    # Tags the models spell in several ways (case, underscores, attention syntax) are suggested to be
+    # replaced by their most frequent spelling
+    def suggest_replace(self, limit=25):
+        variants = {}
+        for tag, count in self.interrogated_tags.items():
+            key = re.sub(r"[\s_]+", " ", re.sub(r"[()\[\]\\]|:\d+(\.\d+)?", "", tag)).strip().lower()
+            variants.setdefault(key, Counter())[tag] += count
+        pairs = []
+        for counts in variants.values():
+            if len(counts) > 1:
+                (preferred, _), *others = counts.most_common()
+                pairs.extend((other, preferred, count) for other, count in others)
+        pairs.sort(key=lambda pair: -pair[2])
+        return [(old, new) for old, new, _ in pairs[:limit]]
+    
+    def as_dict(self):
+        suggested_replace = self.suggest_replace()
+        return {
+            "images": self.images,
+            "final_tags": dict(self.final_tags.most_common()),
+            "interrogated_tags": dict(self.interrogated_tags.most_common()),
+            "model_tags": {model: dict(counts.most_common()) for model, counts in self.model_tags.items()},
+            "filtered_tags": {stage: dict(counts.most_common()) for stage, counts in self.filtered_tags.items()},
+            "keep_tags_fired": dict(self.keep_tags_fired.most_common()),
+            "timeouts": dict(self.timeouts.most_common()),
+            "timeout_fallbacks": dict(self.timeout_fallbacks.most_common()),
+            "suggested_custom_filter": ", ".join(self.suggest_filter()),
+            "suggested_replace_find": ", ".join(old for old, _ in suggested_replace),
+            "suggested_replace_replacements": ", ".join(new for _, new in suggested_replace),
+        }
+    
+    def dump(self, path):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.as_dict(), file, indent=2, ensure_ascii=False)
+        os.replace(temp_path, path)
+        print(f"[{NAME}]: Tag statistics for {self.images} images saved to {path}")
+
+# Compact metadata: the options shared by a batch and the tag vocabulary go once into a JSONL sidecar next to the
+# images, each image only stores "<batch id>:<tag ids>" (base 36, "." separated) and its ratings as "<tag id>=<value>"
+# pairs after a ";". The first sidecar line is {"header": ...}, every later line {"vocab": [tags], "start": first id}.
+compact_metadata_excluded_fields = ("debug_mode", "prompt", "negative_prompt", "custom_filter", "custom_replace_find", "custom_replace_replacements")
+
+def compact_metadata_header(config):
+    header = {name: value for name, value in asdict(config).items() if name not in compact_metadata_excluded_fields}
+    header["filter_hashes"] = {
+        name: hashlib.sha1(getattr(config, name).encode("utf-8")).hexdigest()[:12]
+        for name in ("custom_filter", "custom_replace_find", "custom_replace_replacements")
+    }
+    return header
+
+class CompactMetadataWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        self.batch_id = None
+        self.header = None
+        self.path = None
+        self.ids = {}
+    
+    # Sidecar for `config`, a new batch id starts when the options change
+    def start(self, config):
+        header = compact_metadata_header(config)
+        if header == self.header:
+            return
+        self.batch_id = uuid.uuid4().hex[:12]
+        self.header = header
+        self.ids = {}
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"interrogations-{self.batch_id}.jsonl")
+        self.append({"header": dict(header, batch_id=self.batch_id, format=1)})
+    
+    def append(self, line):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(line, ensure_ascii=False) + "\n")
+    
+    def encode_ids(self, tags):
+        new_tags = [tag for tag in dict.fromkeys(tags) if tag not in self.ids]
+        if new_tags:
+            # The vocabulary is on disk before any image refers to it
+            self.append({"vocab": new_tags, "start": len(self.ids)})
+            for tag in new_tags:
+                self.ids[tag] = len(self.ids)
+        return [np.base_repr(self.ids[tag], 36).lower() for tag in tags]
+    
+    # Per-image value for the final (unweighted) tags and the WD ratings
+    def encode(self, config, final_tags, ratings=None):
+        self.start(config)
+        final_tags = final_tags.rstrip(', ')
+        tags = final_tags.split(", ") if final_tags else []
+        value = f"{self.batch_id}:{'.'.join(self.encode_ids(tags))}"
+        if ratings:
+            keys = self.encode_ids(list(ratings))
+            value += ";" + "/".join(f"{key}={rating:.4g}" for key, rating in zip(keys, ratings.values()))
+        return value
+
+# Decodes compact metadata values of one or more sidecars, sidecars are read once and cached
+class CompactMetadataReader:
+    def __init__(self, directory):
+        self.directory = directory
+        self.sidecars = {}
+    
+    def sidecar(self, batch_id):
+        if batch_id not in self.sidecars:
+            header, vocab = None, []
+            with open(os.path.join(self.directory, f"interrogations-{batch_id}.jsonl"), "r", encoding="utf-8") as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if "header" in entry:
+                        header = entry["header"]
+                    else:
+                        del vocab[entry["start"]:]
+                        vocab.extend(entry["vocab"])
+            self.sidecars[batch_id] = (header, vocab)
+        return self.sidecars[batch_id]
+    
+    # Returns the header, the final tags, the interrogation as saved before compact metadata (weighting included)
+    # and the ratings of an "Img2img batch interrogation" value
+    def decode(self, value):
+        batch_id, _, encoded = value.partition(":")
+        encoded_tags, _, encoded_ratings = encoded.partition(";")
+        header, vocab = self.sidecar(batch_id)
+        tag_ids = [int(tag_id, 36) for tag_id in encoded_tags.split(".") if tag_id]
+        rating_pairs = [pair.partition("=") for pair in encoded_ratings.split("/")] if encoded_ratings else []
+        rating_ids = [int(key, 36) for key, _, _ in rating_pairs]
+        # The sidecar of a running batch may have grown since it was read
+        if max(tag_ids + rating_ids, default=-1) >= len(vocab):
+            del self.sidecars[batch_id]
+            header, vocab = self.sidecar(batch_id)
+        tags = [vocab[tag_id] for tag_id in tag_ids]
+        ratings = {vocab[key]: float(rating) for key, (_, _, rating) in zip(rating_ids, rating_pairs)}
+        interrogation = ", ".join(tags)
+        if header.get("prompt_weight_mode"):
+            interrogation = f"({interrogation}:{header['prompt_weight']})"
+        return {"header": header, "tags": tags, "interrogation": interrogation, "ratings": ratings}
+
 class InterrogationProcessor:
     wd_ext_utils = None
     clip_ext = None
@@ -71,6 +1302,17 @@ class InterrogationProcessor:
     # Mapping of tagger display names to their internal keys
     model_name_to_key = {}
     prompt_contamination = ""
+    # Tag statistics of the running img2img batch, None when disabled
+    tag_statistics = None
+    tag_statistics_path = "extensions/sd-Img2img-batch-interrogator/tag_stats.json"
+    # Interrogator time budgets of the running img2img batch
+    model_budget = None
+    # Sidecar writer of the running img2img batch in compact metadata mode
+    compact_metadata_writer = None
+    # Tag-delta mode: (fingerprint, interrogator options, raw interrogation, ratings) of the last interrogated image
+    delta_cache = None
+    # InterrogationConfig fields that change the raw interrogation, the others only affect postprocessing
+    delta_config_fields = ("model_selection", "clip_ext_model", "clip_ext_mode", "wd_ext_model", "wd_threshold", "wd_underscore_fix", "wd_append_ratings", "wd_ratings", "wd_keep_tags")
 		
     # Checks for CLIP EXT to see if it is installed and enabled
     @classmethod
@@ -160,10 +1402,13 @@ class InterrogationProcessor:
     # Initial Model Options generator, only add supported interrogators, support may vary depending on client
     def get_initial_model_options(self):
         options = ["CLIP (Native)", "Deepbooru (Native)"]
+        if DeepbooruOnnx.is_available():
+            options.append("Deepbooru (ONNX)")
         if is_interrogator_enabled('clip-interrogator-ext'):
             options.insert(0, "CLIP (EXT)")
         if is_interrogator_enabled('stable-diffusion-webui-wd14-tagger'):
             options.append("WD (EXT)")
+        options.extend(custom_interrogators)
         return options
         
     # Gets a list of WD models from WD EXT
@@ -215,6 +1460,27 @@ class InterrogationProcessor:
                 self.save_custom_filter("")
             return ""
             
+    # Reads the last saved tag statistics, empty dict if there are none
+    def load_tag_statistics(self):
+        try:
+            with open(self.tag_statistics_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except Exception as error:
+            print(f"[{NAME} ERROR]: Error loading tag statistics: {error}")
+            return {}
+    
+    # Appends the custom filter suggestions of the last tag statistics to the custom filter
+    def add_suggested_custom_filter(self, custom_filter):
+        suggestion = self.load_tag_statistics().get("suggested_custom_filter", "")
+        return self.clean_string(f"{custom_filter}, {suggestion}")
+    
+    # Appends the find & replace suggestions of the last tag statistics to the find & replace lists
+    def add_suggested_custom_replace(self, custom_replace_find, custom_replace_replacements):
+        statistics = self.load_tag_statistics()
+        pairs = self.parse_replace_pairs(custom_replace_find, custom_replace_replacements) if custom_replace_find.strip() else {}
+        pairs.update((old, new) for old, new in self.parse_replace_pairs(statistics.get("suggested_replace_find", ""), statistics.get("suggested_replace_replacements", "")).items() if old and old not in pairs)
+        return ", ".join(pairs.keys()), ", ".join(pairs.values())
+    
     # Function used to prep custom filter environment with previously saved configuration
     def load_custom_filter_on_start(self):
         return self.load_custom_filter()
@@ -460,37 +1726,10 @@ class InterrogationProcessor:
         if not self.can_insert_at_index() or mode != "Insert at index":
             return gr.HighlightedText.update(visible=False), gr.Slider.update()
 
-        text = prompt if target == "Prompt" else negative_prompt
-        parts = [p.strip() for p in text.split(',') if p.strip()]
-        try:
-            idx = int(index)
-        except Exception:
-            idx = 0
-        idx = max(0, min(idx, len(parts)))
-        highlights = []
-        open_attention = 0
-
-        for p in parts:
-            label = None
-            if re.search(r"<[^>]+>", p):
-                label = "lora"
-            if re.search(r"[\(\[]", p):
-                open_attention += 1
-            if (
-                open_attention > 0
-                or re.search(r"[\)\]]", p)
-                or re.search(r":\d", p)
-            ):
-                label = label or "attention"
-            if re.search(r"[\)\]]", p) and open_attention > 0:
-                open_attention -= len(re.findall(r"[\)\]]", p))
-
-            highlights.append((p, label))
-
-        highlights.insert(idx, ("<interrogation>", "insert"))
+        parsed = parse_prompt(prompt if target == "Prompt" else negative_prompt)
         return (
-            gr.HighlightedText.update(value=highlights, visible=True),
-            gr.Slider.update(maximum=len(parts), value=idx),
+            gr.HighlightedText.update(value=parsed.highlights(index), visible=True),
+            gr.Slider.update(maximum=len(parsed), value=parsed.clamp_index(index)),
         )
     
     # depending on if WD (EXT) is present, WD (EXT) could be removed from model selector
@@ -508,6 +1747,54 @@ class InterrogationProcessor:
             except:
                 return gr.Accordion.update(visible=False), gr.Dropdown.update()
     
+    # Warm-up loads for the selected models, see InterrogatorWarmup. Only the first CLIP (EXT) model is loaded, as the
+    # extension keeps one CLIP model resident at a time.
+    def warmup_loads(self, model_selection, clip_ext_model, wd_ext_model):
+        loads = []
+        for model in model_selection or []:
+            if model == "Deepbooru (Native)":
+                loads.append((("Deepbooru (Native)",), model, deepbooru.model.load))
+            elif model == "Deepbooru (ONNX)":
+                quantize = getattr(shared.opts, "img2img_batch_interrogator_deepbooru_onnx_int8", False)
+                loads.append((("Deepbooru (ONNX)", quantize), model, lambda quantize=quantize: deepbooru_onnx.session(quantize)))
+            elif model == "CLIP (Native)":
+                loads.append((("CLIP (Native)",), model, shared.interrogator.load))
+            elif model == "CLIP (EXT)" and self.clip_ext is not None and clip_ext_model:
+                clip_model = clip_ext_model[0]
+                loads.append((("CLIP (EXT)", clip_model), f"CLIP ({clip_model})", lambda clip_model=clip_model: self.clip_ext.load(clip_model)))
+            elif model == "WD (EXT)" and self.wd_ext_utils is not None:
+                for wd_model_display_name in wd_ext_model or []:
+                    internal_key = self.model_name_to_key.get(wd_model_display_name, wd_model_display_name)
+                    interrogator = self.wd_ext_utils.interrogators.get(internal_key)
+                    if interrogator is not None and hasattr(interrogator, "load"):
+                        loads.append((("WD (EXT)", internal_key), f"WD ({wd_model_display_name})", interrogator.load))
+        # Cheap taggers first, like the interrogation itself
+        return sorted(loads, key=lambda load: interrogator_tiers.get(load[0][0], 3))
+    
+    # Starts loading the selected models in the background, when warm-up is enabled in the settings
+    def warm_up(self, model_selection, clip_ext_model, wd_ext_model):
+        if not getattr(shared.opts, "img2img_batch_interrogator_warmup", True):
+            return
+        try:
+            interrogator_warmup.request(self.warmup_loads(model_selection, clip_ext_model, wd_ext_model))
+        except Exception as error:
+            print(f"[{NAME} ERROR]: Could not start the interrogator warm-up: {error}")
+    
+    # UI listener, warms up on selection changes while the extension is enabled
+    def warm_up_from_ui(self, tag_batch_enabled, model_selection, clip_ext_model, wd_ext_model):
+        if tag_batch_enabled:
+            self.warm_up(model_selection, clip_ext_model, wd_ext_model)
+    
+    # Called once before the img2img job starts, with the same arguments as process_batch
+    def before_process(self, p, *args, **kwargs):
+        try:
+            arguments = inspect.signature(self.process_batch).bind_partial(p, *args, **kwargs).arguments
+        except TypeError as error:
+            print(f"[{NAME} ERROR]: Skipping warm-up, unexpected script arguments: {error}")
+            return
+        if arguments.get("tag_batch_enabled"):
+            self.warm_up(arguments.get("model_selection"), arguments.get("clip_ext_model"), arguments.get("wd_ext_model"))
+    
     #Unloads CLIP Models
     def unload_clip_models(self):
         if self.clip_ext is not None:
@@ -616,6 +1903,8 @@ class InterrogationProcessor:
                     with gr.Row():
                         load_custom_filter_button = gr.Button(value="Load Custom Filter")
                         save_custom_filter_button = gr.Button(value="Save Custom Filter")
+                    # Button to add the noisiest tags of the last tag statistics to the custom filter
+                    suggest_custom_filter_button = gr.Button(value="Add Suggested Filter Entries")
                     save_confirmation_custom_filter = gr.Accordion("Are You Sure You Want to Save?", visible=False)
                     with save_confirmation_custom_filter:
                         with gr.Row():
@@ -649,6 +1938,7 @@ class InterrogationProcessor:
                     with gr.Row():
                         load_custom_replace_button = gr.Button("Load Custom Replace")
                         save_custom_replace_button = gr.Button("Save Custom Replace")
+                    suggest_custom_replace_button = gr.Button("Add Suggested Replace Pairs")
                     save_confirmation_custom_replace = gr.Accordion("Are You Sure You Want to Save?", visible=False)
                     with save_confirmation_custom_replace:
                         with gr.Row():
@@ -665,16 +1955,30 @@ class InterrogationProcessor:
                 prompt_weight_mode = gr.Checkbox(label="Enable Interrogator Prompt Weight Mode", info="[Interrogator Prompt Weight]: Use attention syntax on interrogation.")
                 prompt_weight = gr.Slider(0.0, 1.0, value=0.5, step=0.01, label="Interrogator Prompt Weight", visible=False) 
                 prompt_output = gr.Checkbox(label="Enable Prompt Output", value=True, info="[Prompt Output]: Prompt statements will be printed to console log after every interrogation.")
+                tag_delta_mode = gr.Checkbox(label="Enable Tag-Delta Mode", info="[Tag-Delta Mode]: Reuse the previous interrogation when the image has barely changed since the last interrogation (loopback, batch count > 1).")
+                tag_delta_tolerance = gr.Slider(0.0, 0.2, value=0.02, step=0.001, label="Tag-Delta Tolerance", visible=False)
+                tag_stats_mode = gr.Checkbox(label="Enable Tag Statistics", info="[Tag Statistics]: Count tags per model and per filter stage during the batch, saved with filter suggestions to tag_stats.json when the batch ends.")
+                assembly_policy = gr.Radio(choices=list(assembly_policies), value="keep-first", label="Tag Assembly Policy", info="[Tag Assembly]: Order of the deduplicated tags: first appearance, highest model confidence, or model priority.")
+                model_priority = gr.Textbox(label="Model Priority", placeholder="e.g. WD (EXT), Deepbooru (Native), CLIP (EXT)", visible=False)
+                max_tags = gr.Slider(0, 150, value=0, step=1, label="Max Tags", info="Keep only the first tags after assembly, 0 keeps all tags.")
+                save_provenance = gr.Checkbox(label="Save Tag Provenance", info="[Tag Provenance]: Save which models produced each tag, with their confidences, to the generation parameters.")
+                compact_metadata = gr.Checkbox(label="Enable Compact Metadata", info="[Compact Metadata]: Save the batch options and tag vocabulary once to a sidecar file in the output folder, and only tag IDs per image.")
                 
             # Listeners
             model_selection.change(fn=self.update_clip_ext_visibility, inputs=[model_selection], outputs=[clip_ext_accordion, clip_ext_model])
             model_selection.change(fn=self.update_wd_ext_visibility, inputs=[model_selection], outputs=[wd_ext_accordion, wd_ext_model])
+            for warmup_trigger in (model_selection, clip_ext_model, wd_ext_model):
+                warmup_trigger.change(fn=self.warm_up_from_ui, inputs=[tag_batch_enabled, model_selection, clip_ext_model, wd_ext_model], outputs=None)
             unload_clip_models_button.click(self.unload_clip_models, inputs=None, outputs=None)
             unload_wd_models_button.click(self.unload_wd_models, inputs=None, outputs=None)
             prompt_weight_mode.change(fn=self.update_slider_visibility, inputs=[prompt_weight_mode], outputs=[prompt_weight])
+            tag_delta_mode.change(fn=self.update_slider_visibility, inputs=[tag_delta_mode], outputs=[tag_delta_tolerance])
+            assembly_policy.change(fn=lambda policy: self.update_group_visibility(policy == "model-priority"), inputs=[assembly_policy], outputs=[model_priority])
             wd_append_ratings.change(fn=self.update_slider_visibility, inputs=[wd_append_ratings], outputs=[wd_ratings])
             clean_custom_filter_button.click(self.clean_string, inputs=custom_filter, outputs=custom_filter)
             load_custom_filter_button.click(self.load_custom_filter, inputs=None, outputs=custom_filter)
+            suggest_custom_filter_button.click(self.add_suggested_custom_filter, inputs=custom_filter, outputs=custom_filter)
+            suggest_custom_replace_button.click(fn=self.add_suggested_custom_replace, inputs=[custom_replace_find, custom_replace_replacements], outputs=[custom_replace_find, custom_replace_replacements])
             clean_keep_tags_button.click(self.clean_string, inputs=wd_keep_tags, outputs=wd_keep_tags)
             load_keep_tags_button.click(self.load_keep_tags, inputs=None, outputs=wd_keep_tags)
             save_keep_tags_button.click(self.update_save_confirmation_row_true, inputs=None, outputs=[save_confirmation_keep_tags])
@@ -731,14 +2035,606 @@ class InterrogationProcessor:
         ui = [
             tag_batch_enabled, model_selection, debug_mode, in_front, insert_target, insert_index, prompt_weight_mode, prompt_weight, reverse_mode, exaggeration_mode, prompt_output, use_positive_filter, use_negative_filter,
             use_custom_filter, custom_filter, use_custom_replace, custom_replace_find, custom_replace_replacements, clip_ext_model, clip_ext_mode, wd_ext_model, wd_threshold, wd_underscore_fix, wd_append_ratings, wd_ratings, wd_keep_tags,
-            unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode
+            unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode, tag_delta_mode, tag_delta_tolerance, tag_stats_mode,
+            assembly_policy, model_priority, max_tags, save_provenance, compact_metadata
             ]
         return ui
 
+    # Resolves a WD display name to the internal key used by the WD EXT interrogators, returns None on failure
+    def resolve_wd_model_key(self, wd_model_display_name, debug_mode):
+        # Convert display name to internal key
+        internal_key = self.model_name_to_key.get(wd_model_display_name)
+        
+        # Debug logging for troubleshooting
+        self.debug_print(debug_mode, f"Using model display name: {wd_model_display_name}")
+        self.debug_print(debug_mode, f"Internal key mapped to: {internal_key}")
+        self.debug_print(debug_mode, f"Available model mappings: {self.model_name_to_key}")
+        self.debug_print(debug_mode, f"Available interrogators: {list(self.wd_ext_utils.interrogators.keys())}")
+        
+        # If the mapping is empty, try to regenerate it
+        if not internal_key and not self.model_name_to_key:
+            print(f"[{NAME}]: Model mapping is empty. Attempting to regenerate...")
+            self.get_WD_EXT_models()
+            internal_key = self.model_name_to_key.get(wd_model_display_name)
+        
+        # Fallback: if we still don't have an internal key, try using the display name directly
+        if not internal_key:
+            print(f"[{NAME}]: No internal key found for '{wd_model_display_name}'. Trying direct match...")
+            # Check if the display name exists directly in the interrogators
+            if wd_model_display_name in self.wd_ext_utils.interrogators:
+                internal_key = wd_model_display_name
+            # Try case-insensitive match as last resort
+            else:
+                for key in self.wd_ext_utils.interrogators.keys():
+                    if key.lower() == wd_model_display_name.lower():
+                        internal_key = key
+                        break
+        
+        #Failed State, will try to continue script gracefully
+        if internal_key is None:
+            print(f"[{NAME} ERROR]: No internal key found for display name '{wd_model_display_name}'")
+            print(f"Available mappings: {self.model_name_to_key}")
+            return None
+            
+        #Failed State, will try to continue script gracefully
+        if internal_key not in self.wd_ext_utils.interrogators:
+            print(f"[{NAME} ERROR]: Internal key '{internal_key}' not found in available interrogators")
+            print(f"Available interrogators: {list(self.wd_ext_utils.interrogators.keys())}")
+            return None
+        
+        return internal_key
+    
+    # The WD tags (and appended ratings) of one image as (tag, confidence) pairs, in output order
+    def wd_tag_list(self, tags, rating, config, label, stats=None):
+        tags_list = [tag for tag, conf in tags.items() if conf > config.wd_threshold]
+        if config.wd_keep_tags:
+            for keep_tag in [t.strip() for t in config.wd_keep_tags.split(',') if t.strip()]:
+                tag_key = keep_tag.replace(' ', '_')
+                if tag_key in tags and tag_key not in tags_list:
+                    tags_list.append(tag_key)
+                    if stats is not None:
+                        stats.record_keep_tag(keep_tag)
+        if config.wd_underscore_fix:
+            tag_pairs = [(self.replace_underscores(tag), tags[tag]) for tag in tags_list]
+        else:
+            tag_pairs = [(tag, tags[tag]) for tag in tags_list]
+        preliminary_interrogation = ", ".join(tag for tag, _ in tag_pairs)
+        
+        self.debug_print(config.debug_mode, f"[WD ({label}:{config.wd_threshold})]: [Result]: {preliminary_interrogation}")
+        self.debug_print(config.debug_mode, f"[WD ({label}:{config.wd_threshold})]: [Ratings]: {rating}")
+        if config.wd_append_ratings:
+            qualifying_ratings = [key for key, value in rating.items() if value >= config.wd_ratings]
+            if qualifying_ratings:
+                self.debug_print(config.wd_append_ratings, f"[WD ({label}:{config.wd_threshold})]: Rating sensitivity set to {config.wd_ratings}, therefore rating is: {qualifying_ratings}")
+                tag_pairs.extend((key, rating[key]) for key in qualifying_ratings)
+            else:
+                self.debug_print(config.wd_append_ratings, f"[WD ({label}:{config.wd_threshold})]: Rating sensitivity set to {config.wd_ratings}, unable to determine a rating! Perhaps the rating sensitivity is set too high.")
+        return tag_pairs
+    
+    # Deepbooru over a list of images, the model is started and stopped once for the whole list
+    def deepbooru_tag_batch(self, images):
+        deepbooru.model.start()
+        try:
+            return [deepbooru.model.tag_multi(image) for image in images]
+        finally:
+            deepbooru.model.stop()
+    
+    # Native CLIP over a list of images
+    def clip_native_batch(self, images):
+        return [shared.interrogator.interrogate(image) for image in images]
+    
+    # CLIP EXT over a list of images with one model/mode
+    def clip_ext_batch(self, images, clip_model, clip_ext_mode):
+        with preserved_webui_state():
+            results, features = None, None
+            if clip_ext_mode in ("classic", "fast") and getattr(shared.opts, "img2img_batch_interrogator_clip_flavor_cache", True):
+                try:
+                    results, features = self.clip_ext_flavor_batch(images, clip_model, clip_ext_mode)
+                except Exception as error:
+                    print(f"[{NAME} ERROR]: Cached CLIP flavor ranking failed, falling back to clip-interrogator-ext: {error}")
+            if results is None:
+                results = [self.clip_ext.image_to_prompt(image, clip_ext_mode, clip_model) for image in images]
+            if getattr(shared.opts, "img2img_batch_interrogator_embedding_store", False):
+                try:
+                    self.store_clip_ext_embeddings(images, clip_model, features)
+                except Exception as error:
+                    print(f"[{NAME} ERROR]: Could not store CLIP image embeddings: {error}")
+            return results
+    
+    # Normalized CLIP image features for a list of images as one (N, D) float32 array, encoded in a single forward pass
+    def clip_ext_image_features(self, ci, images):
+        import torch
+        ci._prepare_clip()
+        pixels = torch.stack([ci.clip_preprocess(image) for image in images]).to(ci.device)
+        with torch.no_grad(), torch.autocast(device_type=pixels.device.type, enabled=pixels.device.type == "cuda"):
+            features = ci.clip_model.encode_image(pixels)
+            features = features / features.norm(dim=-1, keepdim=True)
+        return features.float().cpu().numpy()
+    
+    # Loads the clip-interrogator-ext model for direct use and returns its Interrogator. Under --lowvram/--medvram the
+    # Stable Diffusion model is sent to the CPU first, as the ext's image_to_prompt does before every call
+    def load_clip_ext_model(self, clip_model):
+        if getattr(shared.cmd_opts, "lowvram", False) or getattr(shared.cmd_opts, "medvram", False):
+            lowvram.send_everything_to_cpu()
+            devices.torch_gc()
+        self.clip_ext.load(clip_model)
+        return self.clip_ext.ci
+    
+    # Saves the CLIP image embeddings of a batch to the embedding store. `features` are the ones the cached
+    # flavor ranking already computed, when it did not run the missing images are encoded in one pass.
+    def store_clip_ext_embeddings(self, images, clip_model, features=None):
+        store = get_embedding_store(clip_model)
+        hashes = [image_hash(image) for image in images]
+        missing = [i for i, hash_value in enumerate(hashes) if hash_value not in store]
+        if not missing:
+            return
+        if features is None:
+            features = self.clip_ext_image_features(self.load_clip_ext_model(clip_model), [images[i] for i in missing])
+        else:
+            features = features[missing]
+        store.add([hashes[i] for i in missing], features)
+    
+    # Stored images most similar to `image` as (hash, cosine similarity) pairs, for duplicate finding and re-ranking
+    def find_similar_images(self, image, clip_model, count=5):
+        store = get_embedding_store(clip_model)
+        features = self.clip_ext_image_features(self.load_clip_ext_model(clip_model), [image.convert("RGB")])
+        return store.nearest(features, count)[0]
+    
+    # Reimplements clip-interrogator's `classic` and `fast` prompts with batched image features and the cached
+    # label tables. Captions still come from the loaded BLIP model one image at a time. Returns the prompts
+    # and the image features.
+    def clip_ext_flavor_batch(self, images, clip_model, clip_ext_mode):
+        ci = self.load_clip_ext_model(clip_model)
+        truncate_to_fit = getattr(sys.modules[type(ci).__module__], "_truncate_to_fit", None)
+        captions = [ci.generate_caption(image) for image in images]
+        features = self.clip_ext_image_features(ci, images)
+        
+        prompts = []
+        if clip_ext_mode == "classic":
+            ranked = {table_name: clip_flavor_cache.rank(ci, clip_model, table_name, features, 3 if table_name == "flavors" else 1) for table_name in ClipFlavorCache.table_names}
+            for i, caption in enumerate(captions):
+                medium, artist, trending, movement = (ranked[table_name][i][0] for table_name in ("mediums", "artists", "trendings", "movements"))
+                flaves = ", ".join(ranked["flavors"][i])
+                if caption.startswith(medium):
+                    prompts.append(f"{caption} {artist}, {trending}, {movement}, {flaves}")
+                else:
+                    prompts.append(f"{caption}, {medium} {artist}, {trending}, {movement}, {flaves}")
+        else:
+            for caption, tops in zip(captions, clip_flavor_cache.rank_merged(ci, clip_model, features, 32)):
+                prompts.append(caption + ", " + ", ".join(tops))
+        
+        if truncate_to_fit is not None:
+            prompts = [truncate_to_fit(prompt, ci.tokenize) for prompt in prompts]
+        return prompts, features
+    
+    # WD EXT over a list of images with one model, returns (rating, tags) per image or None where the model failed
+    def wd_ext_batch(self, images, internal_key, wd_model_display_name):
+        results = []
+        for image in images:
+            try:
+                results.append(self.wd_ext_utils.interrogators[internal_key].interrogate(image))
+            except Exception as e:
+                print(f"[{NAME} ERROR]: Error interrogating with model '{wd_model_display_name}' (internal key: '{internal_key}'): {str(e)}")
+                results.append(None)
+        return results
+    
+    # Runs batch_fn over images, through the shared micro-batching scheduler when it is enabled so that
+    # concurrent callers (img2img, API, other extensions) asking for the same model share one batch
+    def run_model_batch(self, key, batch_fn, images):
+        if not getattr(shared.opts, "img2img_batch_interrogator_scheduler", True):
+            clock = getattr(model_call_clocks, "current", None)
+            with clock.running() if clock is not None else contextlib.nullcontext():
+                return batch_fn(images)
+        futures = [interrogation_scheduler.submit(key, batch_fn, image) for image in images]
+        return [future.result() for future in futures]
+    
+    # Calls `unload` once after a caller's whole list. The scheduler splits a list into micro-batches, so batch_fn
+    # must not unload; this goes through the scheduler too so it never runs during another batch of the model.
+    def unload_model(self, key, unload):
+        def batch_fn(batch):
+            unload()
+            return [None] * len(batch)
+        self.run_model_batch(key + ("unload",), batch_fn, [None])
+    
+    # Unloads the models of `passes` that are set to unload after use, once per loaded model. A model still busy with
+    # an abandoned call (see ModelTimeouts) is left loaded, that call is using it.
+    def unload_passes(self, passes):
+        unloaded = set()
+        for interrogation_pass in passes:
+            if interrogation_pass.unload is None or interrogation_pass.resource in unloaded or model_timeouts.busy(interrogation_pass.resource):
+                continue
+            unloaded.add(interrogation_pass.resource)
+            interrogation_pass.unload()
+    
+    # Unloads the models `config` selects and sets to unload after use, for callers that ran interrogate_many with
+    # unload=False over several chunks
+    def unload_interrogators(self, config):
+        self.unload_passes(self.interrogation_passes(config))
+    
+    def deepbooru_pass(self):
+        run = lambda images: [(result, None, None) for result in self.run_model_batch(("Deepbooru (Native)",), self.deepbooru_tag_batch, images)]
+        return InterrogationPass("Deepbooru (Native)", "Deepbooru (Native)", run)
+    
+    # clip_ext_batch keeps the WebUI job state, see preserved_webui_state
+    def clip_ext_pass(self, clip_model, clip_ext_mode, config):
+        def run(images):
+            key = ("CLIP (EXT)", clip_model, clip_ext_mode)
+            batch_fn = lambda batch: self.clip_ext_batch(batch, clip_model, clip_ext_mode)
+            return [(result, None, None) for result in self.run_model_batch(key, batch_fn, images)]
+        unload = (lambda: self.unload_model(("CLIP (EXT)",), self.clip_ext.unload)) if config.unload_clip_models_afterwords else None
+        return InterrogationPass(f"CLIP ({clip_model}:{clip_ext_mode})", "CLIP (EXT)", run, clip_ext_mode_tiers.get(clip_ext_mode, 3), resource="CLIP (EXT)", unload=unload)
+    
+    # The interrogator passes selected in `config`, one per model, in user selection order. Each pass maps a list of
+    # RGB images to one (interrogation, ratings, tag confidences) triple per image, all None where the model failed
+    # on that image. Ratings and confidences are None for models that report none.
+    def interrogation_passes(self, config, stats=None):
+        passes = []
+        for model in config.model_selection:
+            # Should add the interrogators in the order determined by the model_selection list
+            if model == "Deepbooru (Native)":
+                passes.append(self.deepbooru_pass())
+            elif model == "Deepbooru (ONNX)":
+                quantize = getattr(shared.opts, "img2img_batch_interrogator_deepbooru_onnx_int8", False)
+                def run(images, quantize=quantize):
+                    batch_fn = lambda batch: deepbooru_onnx.tag_batch(batch, quantize)
+                    return [(result, None, None) for result in self.run_model_batch(("Deepbooru (ONNX)", quantize), batch_fn, images)]
+                passes.append(InterrogationPass("Deepbooru (ONNX)", model, run))
+            elif model == "CLIP (Native)":
+                run = lambda images: [(result, None, None) for result in self.run_model_batch(("CLIP (Native)",), self.clip_native_batch, images)]
+                # Deepbooru is the cheaper stand-in when CLIP times out
+                passes.append(InterrogationPass("CLIP (Native)", model, run, fallback=self.deepbooru_pass()))
+            elif model == "CLIP (EXT)":
+                if self.clip_ext is not None:
+                    for clip_model in config.clip_ext_model:
+                        clip_pass = self.clip_ext_pass(clip_model, config.clip_ext_mode, config)
+                        # Deepbooru is the cheaper stand-in when CLIP times out, another CLIP (EXT) pass would wait for the same model
+                        clip_pass.fallback = self.deepbooru_pass()
+                        passes.append(clip_pass)
+            elif model == "WD (EXT)":
+                if self.wd_ext_utils is not None:
+                    for wd_model_display_name in config.wd_ext_model:
+                        internal_key = self.resolve_wd_model_key(wd_model_display_name, config.debug_mode)
+                        if internal_key is None:
+                            continue
+                        def run(images, internal_key=internal_key, wd_model_display_name=wd_model_display_name):
+                            label = f"{wd_model_display_name}/{internal_key}"
+                            key = ("WD (EXT)", internal_key)
+                            batch_fn = lambda batch: self.wd_ext_batch(batch, internal_key, wd_model_display_name)
+                            results = []
+                            for result in self.run_model_batch(key, batch_fn, images):
+                                # Failed State, the error was already reported by wd_ext_batch
+                                if result is None:
+                                    results.append((None, None, None))
+                                    continue
+                                rating, tags = result
+                                self.debug_print(config.debug_mode, f"Successfully interrogated using model: {wd_model_display_name} (internal key: {internal_key})")
+                                tag_pairs = self.wd_tag_list(tags, rating, config, label, stats)
+                                results.append((", ".join(tag for tag, _ in tag_pairs), rating, dict(tag_pairs)))
+                            return results
+                        unload = None
+                        if config.unload_wd_models_afterwords and internal_key in self.wd_ext_utils.interrogators:
+                            unload = lambda internal_key=internal_key: self.unload_model(("WD (EXT)", internal_key), self.wd_ext_utils.interrogators[internal_key].unload)
+                        passes.append(InterrogationPass(f"WD ({wd_model_display_name})", model, run, unload=unload))
+            elif model in custom_interrogators:
+                batch_fn, tier = custom_interrogators[model]
+                run = lambda images, model=model, batch_fn=batch_fn: [(result, None, None) for result in self.run_model_batch((model,), batch_fn, images)]
+                passes.append(InterrogationPass(model, model, run, tier))
+        return passes
+    
+    # Runs `passes` over a list of RGB images, cheapest tier first when config.cheap_first is set. Passes whose time
+    # budget is spent are skipped. Returns the results of every pass, all None per image for passes that did not run,
+    # and whether the job was interrupted. The WebUI job (`cancelled` None) follows the skip and interrupt buttons
+    # through shared.state, background callers pass their own `cancelled` callable instead and leave state alone.
+    # With `unload` each model is unloaded after its pass if the config says so, callers running the passes over
+    # several chunks pass False and unload after the last one.
+    def run_interrogation_passes(self, passes, images, config, stats=None, budget=None, cancelled=None, unload=True):
+        with interrogator_warmup.interrogating():
+            return self.run_interrogation_passes_unlocked(passes, images, config, stats, budget, cancelled, unload)
+    
+    def run_interrogation_passes_unlocked(self, passes, images, config, stats=None, budget=None, cancelled=None, unload=True):
+        outputs = [[(None, None, None)] * len(images) for _ in passes]
+        order = sorted(range(len(passes)), key=lambda index: passes[index].tier) if config.cheap_first else range(len(passes))
+        
+        # Interrogator interrogation loop
+        for index in order:
+            interrogation_pass = passes[index]
+            if cancelled is not None:
+                if cancelled():
+                    return outputs, True
+            else:
+                # Check for skipped job
+                if state.skipped:
+                    print("Job skipped.")
+                    state.skipped = False
+                    continue
+                
+                # Check for interruption
+                if state.interrupted:
+                    print("Job interrupted. Ending process.")
+                    state.interrupted = False
+                    return outputs, True
+            
+            if budget is not None and not budget.allows(interrogation_pass, len(images)):
+                continue
+            
+            start = time.perf_counter()
+            outputs[index] = self.run_pass(interrogation_pass, images, config, stats)
+            if budget is not None:
+                budget.charge(interrogation_pass, time.perf_counter() - start)
+            if unload:
+                self.unload_passes([interrogation_pass])
+            for interrogation, *_ in outputs[index]:
+                if interrogation is None:
+                    continue
+                self.debug_print(config.debug_mode, f"[{interrogation_pass.label}]: [Result]: {interrogation}")
+                if stats is not None:
+                    stats.record_model(interrogation_pass.label, interrogation)
+        return outputs, False
+    
+    # Runs one pass, on a worker thread with a time limit when a timeout applies to it (see ModelTimeouts). A pass that
+    # times out, or whose model is still busy with an abandoned call, is replaced per config.timeout_fallback: no
+    # result, the last result of the model for the same image, or the result of a cheaper model.
+    def run_pass(self, interrogation_pass, images, config, stats=None):
+        timeouts, fallback = ModelTimeouts.settings(config)
+        key = model_seconds_key(timeouts, interrogation_pass)
+        busy = model_timeouts.busy(interrogation_pass.resource)
+        if key is None and not busy:
+            return interrogation_pass.run(images)
+        
+        hashes = [image_hash(image) for image in images] if fallback == "cached" else None
+        results = None if busy else model_timeouts.run(interrogation_pass, images, timeouts[key] * len(images))
+        if results is not None:
+            if hashes is not None:
+                model_timeouts.remember(interrogation_pass.label, hashes, results)
+            return results
+        
+        if fallback == "cheaper" and interrogation_pass.fallback is None:
+            fallback = "skip"
+        if busy:
+            print(f"[{NAME}]: {interrogation_pass.label} skipped on {len(images)} image(s), {interrogation_pass.resource} is still running a timed out call, fallback: {fallback}.")
+        else:
+            print(f"[{NAME}]: {interrogation_pass.label} timed out after {timeouts[key]:g}s per image on {len(images)} image(s), fallback: {fallback}.")
+        with model_timeouts.lock:
+            model_timeouts.timeouts[interrogation_pass.label] += len(images)
+        if stats is not None:
+            stats.record_timeout(interrogation_pass.label, len(images), fallback)
+        if fallback == "cached":
+            return model_timeouts.cached(interrogation_pass.label, hashes)
+        if fallback == "cheaper":
+            return self.run_pass(interrogation_pass.fallback, images, config, stats)
+        return [(None, None, None)] * len(images)
+    
+    # Collects the pass results into one TagAssembly per image in user selection order, whatever order the passes ran in
+    def assemble_interrogations(self, passes, outputs, image_count):
+        assemblies = [TagAssembly() for _ in range(image_count)]
+        ratings = [{} for _ in range(image_count)]
+        for interrogation_pass, pass_outputs in zip(passes, outputs):
+            for i, (interrogation, rating, confidences) in enumerate(pass_outputs):
+                if interrogation is not None:
+                    assemblies[i].add(interrogation_pass.label, interrogation, confidences, interrogation_pass.model)
+                if rating is not None:
+                    ratings[i] = rating
+        return assemblies, ratings
+    
+    # Runs the selected interrogators over a list of RGB images. Each model handles the whole list before the next
+    # one so loading/unloading happens once per list, cheap taggers first (see interrogator_tiers).
+    # Returns the raw (unfiltered) interrogations as TagAssembly, in user selection order, and the WD ratings for every image.
+    def interrogate_images(self, images, config, stats=None, budget=None):
+        passes = self.interrogation_passes(config, stats)
+        outputs, _ = self.run_interrogation_passes(passes, images, config, stats, budget)
+        return self.assemble_interrogations(passes, outputs, len(images))
+    
+    # Cheap fingerprint of an image for tag-delta mode: 16x16 RGB thumbnail as floats in [0, 1]
+    def image_fingerprint(self, image):
+        return np.asarray(image.resize((16, 16), Image.BOX), dtype=np.float32) / 255
+    
+    # Tag-delta mode, reuses the previous raw interrogation when the interrogator options are unchanged and the
+    # image fingerprint differs by no more than `tolerance` (mean absolute difference). Returns the raw
+    # interrogation, the ratings and a note for the generation parameters.
+    def interrogate_with_delta(self, image, config, tolerance, stats=None, budget=None):
+        fingerprint = self.image_fingerprint(image)
+        config_key = json.dumps({name: getattr(config, name) for name in self.delta_config_fields}, sort_keys=True)
+        if self.delta_cache is not None and self.delta_cache[1] == config_key:
+            difference = float(np.abs(fingerprint - self.delta_cache[0]).mean())
+            if difference <= tolerance:
+                self.debug_print(config.debug_mode, f"[Tag-Delta]: difference {difference:.4f} <= {tolerance}, reusing previous interrogation")
+                return self.delta_cache[2], self.delta_cache[3], f"reused (difference {difference:.4f})"
+            note = f"interrogated (difference {difference:.4f})"
+        else:
+            note = "interrogated (no previous image)"
+        self.debug_print(config.debug_mode, f"[Tag-Delta]: {note}")
+        raw_interrogations, ratings = self.interrogate_images([image], config, stats, budget)
+        self.delta_cache = (fingerprint, config_key, raw_interrogations[0], ratings[0])
+        return raw_interrogations[0], ratings[0], note
+    
+    # Applies dedup, find & replace, filters, punctuation and weighting to a raw interrogation string
+    # `interrogation` is a TagAssembly or a raw interrogation string
+    def postprocess_interrogation(self, interrogation, config, stats=None):
+        return self.weight_interrogation(self.filter_interrogation(interrogation, config, stats), config)
+    
+    # Postprocessing up to, not including, weighting; returns the final tags
+    def filter_interrogation(self, interrogation, config, stats=None):
+        assembly = interrogation if isinstance(interrogation, TagAssembly) else TagAssembly.parse(interrogation)
+        interrogation = assembly.raw
+        # Filter prevents overexaggeration of tags due to interrogation models having similar results 
+        if not config.exaggeration_mode:
+            interrogation = assembly.assemble(config.assembly_policy, config.model_priority, config.max_tags)
+            if stats is not None:
+                stats.record_filter("duplicates", assembly.raw, interrogation)
+        
+        # Find and Replace user defined words in the interrogation prompt
+        if config.use_custom_replace:
+            replace_pairs = self.parse_replace_pairs(config.custom_replace_find, config.custom_replace_replacements)
+            before = interrogation
+            interrogation = self.custom_replace(interrogation, replace_pairs)
+            if stats is not None:
+                stats.record_filter("replace", before, interrogation)
+        
+        # Remove duplicate prompt content from interrogator prompt
+        if config.use_positive_filter:
+            before = interrogation
+            interrogation = self.filter_words(interrogation, config.prompt)
+            if stats is not None:
+                stats.record_filter("positive", before, interrogation)
+        # Remove negative prompt content from interrogator prompt
+        if config.use_negative_filter:
+            before = interrogation
+            interrogation = self.filter_words(interrogation, config.negative_prompt)
+            if stats is not None:
+                stats.record_filter("negative", before, interrogation)
+        # Remove custom prompt content from interrogator prompt
+        if config.use_custom_filter:
+            before = interrogation
+            interrogation = self.filter_words(interrogation, config.custom_filter)
+            if stats is not None:
+                stats.record_filter("custom", before, interrogation)
+
+        # Experimental tool for removing puncuations, but commas and a variety of emojis
+        if config.no_puncuation_mode:
+            interrogation = self.remove_punctuation(interrogation)
+        
+        if stats is not None:
+            stats.record_final(interrogation)
+        return interrogation
+    
+    def weight_interrogation(self, interrogation, config):
+        # This will weight the interrogation, and also ensure that trailing commas to the interrogation are correctly placed.
+        if config.prompt_weight_mode:
+            interrogation = f"({interrogation.rstrip(', ')}:{config.prompt_weight}), "
+        else:
+            interrogation = f"{interrogation.rstrip(', ')}, "
+        return interrogation
+    
+    def interrogate_many(self, images: Iterable[Any], config: Optional[InterrogationConfig] = None, stats: Optional[TagStatistics] = None, budget: Optional[ModelTimeBudget] = None, cancelled: Optional[Callable[[], bool]] = None, unload: bool = True, **options) -> List[ImageInterrogation]:
+        """
+        Interrogates every image in `images` (PIL images or file paths) and returns one ImageInterrogation per
+        image, in input order. Options come from `config` and/or keyword arguments named like the
+        InterrogationConfig fields. No processing object is touched and the prompt contamination state of the
+        img2img script is left alone. Images are decoded `stream_chunk_size` at a time at reduced size, so memory
+        does not grow with the number or resolution of the inputs. Pass a TagStatistics as `stats` to count tags.
+        The cheap taggers run over all images before the CLIP models, and each model stops once its time budget is
+        spent (`budget`, or one made from config.model_time_budgets), so every image gets a caption even when the
+        expensive models run out of time. The models of each result stay in selection order. Raises
+        InterrogationInterrupted when the job is interrupted, the partial results are dropped. Without `cancelled`
+        the WebUI skip and interrupt buttons apply; callers on their own thread pass a callable such as
+        `threading.Event().is_set` instead, so the WebUI job state is never read or reset.
+        Chunks only bound decoding: each model goes over all images before it is unloaded (per the unload options),
+        so it is loaded and unloaded once per call. Callers that split their own work over several calls pass
+        `unload=False` and call unload_interrogators(config) at the end.
+        """
+        if config is None:
+            config = InterrogationConfig(**options)
+        elif options:
+            config = replace(config, **options)
+        if budget is None:
+            budget = ModelTimeBudget.from_config(config)
+        
+        sources = list(images)
+        if not config.model_selection:
+            return [ImageInterrogation() for _ in sources]
+        
+        # With cheap_first every tier goes over all images before the next, more expensive, tier starts. Within a
+        # tier, passes sharing a loaded model (every CLIP (EXT) model runs on one clip-interrogator) go over all images
+        # one after the other, so the model is switched once per pass and not once per chunk
+        passes = self.interrogation_passes(config, stats)
+        tiers = sorted({interrogation_pass.tier for interrogation_pass in passes}) if config.cheap_first else [None]
+        rounds = []
+        for tier in tiers:
+            tier_rounds, resource_passes = [], Counter()
+            for index, interrogation_pass in enumerate(passes):
+                if tier is not None and interrogation_pass.tier != tier:
+                    continue
+                position = resource_passes[interrogation_pass.resource]
+                resource_passes[interrogation_pass.resource] += 1
+                if position == len(tier_rounds):
+                    tier_rounds.append([])
+                tier_rounds[position].append(index)
+            rounds.extend(tier_rounds)
+        
+        outputs = [[(None, None, None)] * len(sources) for _ in passes]
+        chunk_size = max(1, config.stream_chunk_size)
+        try:
+            for selected in rounds:
+                for start in range(0, len(sources), chunk_size):
+                    chunk = [load_interrogation_image(source, config.max_image_side) for source in sources[start:start + chunk_size]]
+                    try:
+                        chunk_outputs, interrupted = self.run_interrogation_passes([passes[index] for index in selected], chunk, config, stats, budget, cancelled, unload=False)
+                    finally:
+                        for image in chunk:
+                            image.close()
+                    if interrupted:
+                        raise InterrogationInterrupted(f"Interrupted after {start} of {len(sources)} images")
+                    for index, pass_outputs in zip(selected, chunk_outputs):
+                        outputs[index][start:start + len(chunk)] = pass_outputs
+                if unload:
+                    self.unload_passes([passes[index] for index in selected])
+        except BaseException:
+            if unload:
+                self.unload_passes(passes)
+            raise
+        
+        results = []
+        for assembly, rating in zip(*self.assemble_interrogations(passes, outputs, len(sources))):
+            tags = self.filter_interrogation(assembly, config, stats)
+            interrogation = self.weight_interrogation(tags, config).rstrip(', ')
+            results.append(ImageInterrogation(raw=assembly.raw.rstrip(', '), interrogation=interrogation, ratings=rating, provenance=assembly.provenance(tags)))
+        return results
+    
+    # Interrogates this node's shard of `input_dir` (see shard_for) and appends the results to its shard file in
+    # `output_dir`. Images already in the shard file are skipped, so an interrupted shard can simply be rerun. Only
+    # fully interrogated chunks are written, an interrupt drops the chunk in progress and leaves out the .done marker.
+    # `cancelled` as for interrogate_many.
+    def interrogate_shard(self, input_dir, output_dir, shard_index, shard_count, config=None, cancelled=None, **options):
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Shard index {shard_index} is not in range for {shard_count} shards")
+        if config is None:
+            config = InterrogationConfig(**options)
+        elif options:
+            config = replace(config, **options)
+        
+        os.makedirs(output_dir, exist_ok=True)
+        shard_path = os.path.join(output_dir, shard_file_name(shard_index, shard_count))
+        done = read_shard_results(shard_path)
+        # Cut a partial last line left by an interrupted run so new lines start cleanly
+        if os.path.exists(shard_path):
+            with open(shard_path, "r+b") as file:
+                content = file.read()
+                if content and not content.endswith(b"\n"):
+                    file.truncate(content.rfind(b"\n") + 1)
+        paths = [path for path in list_shard_images(input_dir, shard_index, shard_count) if path not in done]
+        print(f"[{NAME}]: Shard {shard_index}/{shard_count}: {len(paths)} images to interrogate, {len(done)} already done.")
+        
+        chunk_size = max(1, config.stream_chunk_size)
+        budget = ModelTimeBudget.from_config(config)
+        # Models stay loaded from chunk to chunk and are unloaded once when the run ends
+        try:
+            with open(shard_path, "a", encoding="utf-8") as file:
+                for start in range(0, len(paths), chunk_size):
+                    if cancelled() if cancelled is not None else state.interrupted:
+                        print(f"[{NAME}]: Shard {shard_index}/{shard_count} interrupted.")
+                        return {"shard_file": shard_path, "completed": len(done) + start, "done": False}
+                    chunk = paths[start:start + chunk_size]
+                    try:
+                        results = self.interrogate_many([os.path.join(input_dir, path) for path in chunk], config, budget=budget, cancelled=cancelled, unload=False)
+                    except InterrogationInterrupted:
+                        print(f"[{NAME}]: Shard {shard_index}/{shard_count} interrupted.")
+                        return {"shard_file": shard_path, "completed": len(done) + start, "done": False}
+                    for path, result in zip(chunk, results):
+                        file.write(json.dumps({"path": path, "raw": result.raw, "interrogation": result.interrogation, "ratings": result.ratings}) + "\n")
+                    file.flush()
+        finally:
+            if paths:
+                self.unload_interrogators(config)
+        
+        with open(f"{shard_path}.done", "w", encoding="utf-8") as file:
+            json.dump({"images": len(done) + len(paths)}, file)
+        return {"shard_file": shard_path, "completed": len(done) + len(paths), "done": True}
+    
     def process_batch(
         self, p, tag_batch_enabled, model_selection, debug_mode, in_front, insert_target, insert_index, prompt_weight_mode, prompt_weight, reverse_mode, exaggeration_mode, prompt_output, use_positive_filter, use_negative_filter,
         use_custom_filter, custom_filter, use_custom_replace, custom_replace_find, custom_replace_replacements, clip_ext_model, clip_ext_mode, wd_ext_model, wd_threshold, wd_underscore_fix, wd_append_ratings, wd_ratings, wd_keep_tags,
-        unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode, batch_number, prompts, seeds, subseeds,
+        unload_clip_models_afterwords, unload_wd_models_afterwords, no_puncuation_mode, tag_delta_mode=False, tag_delta_tolerance=0.02, tag_stats_mode=False,
+        assembly_policy="keep-first", model_priority="", max_tags=0, save_provenance=False, compact_metadata=False, batch_number=0, prompts=None, seeds=None, subseeds=None,
         prompt_override=None, image_override=None, update_p=True):
             
         if not tag_batch_enabled:
@@ -746,7 +2642,8 @@ class InterrogationProcessor:
 
         original_prompt = p.prompt
         original_negative = p.negative_prompt
-        original_image = p.init_images[0] if p.init_images else None
+        # Only kept when p has to be restored, so the full resolution image is not held any longer than needed
+        original_image = p.init_images[0] if p.init_images and not update_p else None
 
         if prompt_override is not None:
             if reverse_mode:
@@ -763,6 +2660,9 @@ class InterrogationProcessor:
             if state.job_no <= 0:
                 self.debug_print(debug_mode, f"Condition met for reset, calling reset_prompt_contamination")
                 self.reset_prompt_contamination(debug_mode)
+                self.tag_statistics = TagStatistics() if tag_stats_mode else None
+                self.model_budget = None
+                self.compact_metadata_writer = None
             #self.debug_print(debug_mode, f"prompt_contamination: {self.prompt_contamination}")
             # Experimental reverse mode cleaner
             if not reverse_mode:
@@ -774,179 +2674,52 @@ class InterrogationProcessor:
             
             # local variable preperations
             self.debug_print(debug_mode, f"Initial p.prompt: {p.prompt}")
-            preliminary_interrogation = ""
-            interrogation = ""
-            rating = {}
-            
-            # fix alpha channel
-            init_image = p.init_images[0]
-            p.init_images[0] = p.init_images[0].convert("RGB")
+            config = InterrogationConfig(
+                model_selection=model_selection, debug_mode=debug_mode, prompt_weight_mode=prompt_weight_mode, prompt_weight=prompt_weight,
+                exaggeration_mode=exaggeration_mode, use_positive_filter=use_positive_filter, use_negative_filter=use_negative_filter,
+                use_custom_filter=use_custom_filter, custom_filter=custom_filter, use_custom_replace=use_custom_replace,
+                custom_replace_find=custom_replace_find, custom_replace_replacements=custom_replace_replacements,
+                clip_ext_model=clip_ext_model, clip_ext_mode=clip_ext_mode, wd_ext_model=wd_ext_model, wd_threshold=wd_threshold,
+                wd_underscore_fix=wd_underscore_fix, wd_append_ratings=wd_append_ratings, wd_ratings=wd_ratings, wd_keep_tags=wd_keep_tags,
+                unload_clip_models_afterwords=unload_clip_models_afterwords, unload_wd_models_afterwords=unload_wd_models_afterwords,
+                no_puncuation_mode=no_puncuation_mode, assembly_policy=assembly_policy,
+                model_priority=[model.strip() for model in model_priority.split(',') if model.strip()], max_tags=int(max_tags),
+                prompt=p.prompt, negative_prompt=p.negative_prompt,
+                # The WebUI settings in effect, so the compact metadata header records them instead of the defaults
+                max_image_side=int(getattr(shared.opts, "img2img_batch_interrogator_max_side", 1024)),
+                model_time_budgets=parse_model_seconds(getattr(shared.opts, "img2img_batch_interrogator_model_budgets", "")),
+                model_timeouts=parse_model_seconds(getattr(shared.opts, "img2img_batch_interrogator_model_timeouts", "")),
+                timeout_fallback=getattr(shared.opts, "img2img_batch_interrogator_timeout_fallback", "skip"),
+            )
             
-            # Interrogator interrogation loop
-            for model in model_selection:
-                # Check for skipped job
-                if state.skipped:
-                    print("Job skipped.")
-                    state.skipped = False
-                    continue
-                    
-                # Check for interruption
-                if state.interrupted:
-                    print("Job interrupted. Ending process.")
-                    state.interrupted = False
-                    break
-                    
-                # Should add the interrogators in the order determined by the model_selection list
-                if model == "Deepbooru (Native)":
-                    preliminary_interrogation = deepbooru.model.tag(p.init_images[0]) 
-                    self.debug_print(debug_mode, f"[Deepbooru (Native)]: [Result]: {preliminary_interrogation}")
-                    interrogation += f"{preliminary_interrogation}, "
-                elif model == "CLIP (Native)":
-                    preliminary_interrogation = shared.interrogator.interrogate(p.init_images[0]) 
-                    self.debug_print(debug_mode, f"[CLIP (Native)]: [Result]: {preliminary_interrogation}")
-                    interrogation += f"{preliminary_interrogation}, "
-                elif model == "CLIP (EXT)":
-                    if self.clip_ext is not None:
-                        for clip_model in clip_ext_model:
-                            # Clip-Ext resets state.job system during runtime...
-                            job = state.job
-                            job_no = state.job_no
-                            job_count = state.job_count
-                            # Check for skipped job
-                            if state.skipped:
-                                print("Job skipped.")
-                                state.skipped = False
-                                continue
-                            # Check for interruption
-                            if state.interrupted:
-                                print("Job interrupted. Ending process.")
-                                state.interrupted = False
-                                break
-                            preliminary_interrogation = self.clip_ext.image_to_prompt(p.init_images[0], clip_ext_mode, clip_model) 
-                            if unload_clip_models_afterwords:
-                                self.clip_ext.unload()
-                            self.debug_print(debug_mode, f"[CLIP ({clip_model}:{clip_ext_mode})]: [Result]: {preliminary_interrogation}")
-                            interrogation += f"{preliminary_interrogation}, "
-                            # Redeclare variables for state.job system
-                            state.job = job
-                            state.job_no = job_no
-                            state.job_count = job_count
-                elif model == "WD (EXT)":
-                    if self.wd_ext_utils is not None:
-                        for wd_model_display_name in wd_ext_model:
-                            # Check for skipped job
-                            if state.skipped:
-                                print("Job skipped.")
-                                state.skipped = False
-                                continue
-                            # Check for interruption
-                            if state.interrupted:
-                                print("Job interrupted. Ending process.")
-                                state.interrupted = False
-                                break
-                                
-                            # Convert display name to internal key
-                            internal_key = self.model_name_to_key.get(wd_model_display_name)
-                            
-                            # Debug logging for troubleshooting
-                            self.debug_print(debug_mode, f"Using model display name: {wd_model_display_name}")
-                            self.debug_print(debug_mode, f"Internal key mapped to: {internal_key}")
-                            self.debug_print(debug_mode, f"Available model mappings: {self.model_name_to_key}")
-                            self.debug_print(debug_mode, f"Available interrogators: {list(self.wd_ext_utils.interrogators.keys())}")
-                            
-                            # If the mapping is empty, try to regenerate it
-                            if not internal_key and not self.model_name_to_key:
-                                print(f"[{NAME}]: Model mapping is empty. Attempting to regenerate...")
-                                self.get_WD_EXT_models()
-                                internal_key = self.model_name_to_key.get(wd_model_display_name)
-                            
-                            # Fallback: if we still don't have an internal key, try using the display name directly
-                            if not internal_key:
-                                print(f"[{NAME}]: No internal key found for '{wd_model_display_name}'. Trying direct match...")
-                                # Check if the display name exists directly in the interrogators
-                                if wd_model_display_name in self.wd_ext_utils.interrogators:
-                                    internal_key = wd_model_display_name
-                                # Try case-insensitive match as last resort
-                                else:
-                                    for key in self.wd_ext_utils.interrogators.keys():
-                                        if key.lower() == wd_model_display_name.lower():
-                                            internal_key = key
-                                            break
-                            
-                            #Failed State, will try to continue script gracefully
-                            if internal_key is None:
-                                print(f"[{NAME} ERROR]: No internal key found for display name '{wd_model_display_name}'")
-                                print(f"Available mappings: {self.model_name_to_key}")
-                                continue
-                                
-                            #Failed State, will try to continue script gracefully
-                            if internal_key not in self.wd_ext_utils.interrogators:
-                                print(f"[{NAME} ERROR]: Internal key '{internal_key}' not found in available interrogators")
-                                print(f"Available interrogators: {list(self.wd_ext_utils.interrogators.keys())}")
-                                continue
-                                
-                            # Use the internal key to access the interrogator
-                            try:
-                                rating, tags = self.wd_ext_utils.interrogators[internal_key].interrogate(p.init_images[0])
-                                self.debug_print(debug_mode, f"Successfully interrogated using model: {wd_model_display_name} (internal key: {internal_key})")
-                            except Exception as e:
-                                print(f"[{NAME} ERROR]: Error interrogating with model '{wd_model_display_name}' (internal key: '{internal_key}'): {str(e)}")
-                                continue
-                                	
-                            tags_list = [tag for tag, conf in tags.items() if conf > wd_threshold]
-                            if wd_keep_tags:
-                                for keep_tag in [t.strip() for t in wd_keep_tags.split(',') if t.strip()]:
-                                    tag_key = keep_tag.replace(' ', '_')
-                                    if tag_key in tags and tag_key not in tags_list:
-                                        tags_list.append(tag_key)
-                            if wd_underscore_fix:
-                                tags_spaced = [self.replace_underscores(tag) for tag in tags_list]
-                                preliminary_interrogation = ", ".join(tags_spaced)
-                            else:
-                                preliminary_interrogation = ", ".join(tags_list)
-                            
-                            if unload_wd_models_afterwords and internal_key in self.wd_ext_utils.interrogators:
-                                self.wd_ext_utils.interrogators[internal_key].unload()
-                                
-                            self.debug_print(debug_mode, f"[WD ({wd_model_display_name}/{internal_key}:{wd_threshold})]: [Result]: {preliminary_interrogation}")
-                            self.debug_print(debug_mode, f"[WD ({wd_model_display_name}/{internal_key}:{wd_threshold})]: [Ratings]: {rating}")
-                            if wd_append_ratings:
-                                qualifying_ratings = [key for key, value in rating.items() if value >= wd_ratings]
-                                if qualifying_ratings:
-                                    self.debug_print(wd_append_ratings, f"[WD ({wd_model_display_name}/{internal_key}:{wd_threshold})]: Rating sensitivity set to {wd_ratings}, therefore rating is: {qualifying_ratings}")
-                                    preliminary_interrogation += ", " + ", ".join(qualifying_ratings)
-                                else:
-                                    self.debug_print(wd_append_ratings, f"[WD ({wd_model_display_name}/{internal_key}:{wd_threshold})]: Rating sensitivity set to {wd_ratings}, unable to determine a rating! Perhaps the rating sensitivity is set too high.")
-                            interrogation += f"{preliminary_interrogation}, "
-                            
-            # Filter prevents overexaggeration of tags due to interrogation models having similar results 
-            if not exaggeration_mode:
-                interrogation = self.clean_string(interrogation)
+            # Statistics may have been switched on in the middle of a batch
+            if tag_stats_mode and self.tag_statistics is None:
+                self.tag_statistics = TagStatistics()
+            stats = self.tag_statistics if tag_stats_mode else None
+            # Time budgets are spent over the whole batch
+            if self.model_budget is None:
+                self.model_budget = ModelTimeBudget.from_config(config)
             
-            # Find and Replace user defined words in the interrogation prompt
-            if use_custom_replace:
-                replace_pairs = self.parse_replace_pairs(custom_replace_find, custom_replace_replacements)
-                interrogation = self.custom_replace(interrogation, replace_pairs)
-            
-            # Remove duplicate prompt content from interrogator prompt
-            if use_positive_filter:
-                interrogation = self.filter_words(interrogation, p.prompt)
-            # Remove negative prompt content from interrogator prompt
-            if use_negative_filter:
-                interrogation = self.filter_words(interrogation, p.negative_prompt)
-            # Remove custom prompt content from interrogator prompt
-            if use_custom_filter:
-                interrogation = self.filter_words(interrogation, custom_filter)
-
-            # Experimental tool for removing puncuations, but commas and a variety of emojis
-            if no_puncuation_mode:
-                interrogation = self.remove_punctuation(interrogation)
+            # fix alpha channel, the interrogators receive a reduced RGB copy so p.init_images is never modified
+            rgb_image = load_interrogation_image(p.init_images[0], config.max_image_side)
+            delta_note = None
+            try:
+                if tag_delta_mode:
+                    raw_interrogation, rating, delta_note = self.interrogate_with_delta(rgb_image, config, tag_delta_tolerance, stats, self.model_budget)
+                else:
+                    raw_interrogations, ratings = self.interrogate_images([rgb_image], config, stats, self.model_budget)
+                    raw_interrogation, rating = raw_interrogations[0], ratings[0]
+            finally:
+                rgb_image.close()
+            final_tags = self.filter_interrogation(raw_interrogation, config, stats)
+            interrogation = self.weight_interrogation(final_tags, config)
             
-            # This will weight the interrogation, and also ensure that trailing commas to the interrogation are correctly placed.
-            if prompt_weight_mode:
-                interrogation = f"({interrogation.rstrip(', ')}:{prompt_weight}), "
-            else:
-                interrogation = f"{interrogation.rstrip(', ')}, "
+            # Tag statistics are saved once the last image of the batch is interrogated
+            if stats is not None and state.job_no + 1 >= state.job_count:
+                try:
+                    stats.dump(self.tag_statistics_path)
+                except Exception as error:
+                    print(f"[{NAME} ERROR]: Error saving tag statistics: {error}")
             
             # Experimental reverse mode prep
             if not reverse_mode:
@@ -961,13 +2734,7 @@ class InterrogationProcessor:
                 prompt = f"{prompt.rstrip(', ')}, {interrogation}"
             elif in_front == "Insert at index" and self.can_insert_at_index():
                 base = p.prompt if insert_target == "Prompt" else p.negative_prompt
-                parts = [x.strip() for x in base.split(',') if x.strip()]
-                try:
-                    idx = int(insert_index)
-                except Exception:
-                    idx = 0
-                idx = max(0, min(idx, len(parts)))
-                new_prompt = ", ".join(parts[:idx] + [interrogation.rstrip(', ')] + parts[idx:])
+                new_prompt = parse_prompt(base).splice(insert_index, interrogation.rstrip(', '))
                 if insert_target == "Prompt":
                     prompt = new_prompt
                 else:
@@ -987,7 +2754,8 @@ class InterrogationProcessor:
                 p.prompt = prompt
                 for i in range(len(p.all_prompts)):
                     p.all_prompts[i] = prompt
-                for i in range(len(prompts)):
+                # Only the img2img batch passes prompts, plugin calls may leave it out
+                for i in range(len(prompts or [])):
                     prompts[i] = re.sub("[<].*[>]", "", prompt)
                 if in_front == "Insert at index" and self.can_insert_at_index() and insert_target == "Negative prompt":
                     for i in range(len(p.all_negative_prompts)):
@@ -997,9 +2765,6 @@ class InterrogationProcessor:
                 for i in range(len(p.all_negative_prompts)):
                     p.all_negative_prompts[i] = prompt
                 
-            # Restore Alpha Channel
-            p.init_images[0] = init_image
-            
             # Prep for reset
             self.prompt_contamination = interrogation
             
@@ -1011,16 +2776,32 @@ class InterrogationProcessor:
             result_prompt = prompt
 
             interrogation_result = interrogation.rstrip(', ')
-            p.extra_generation_params["\nImg2img batch interrogation result"] = interrogation_result
+            if compact_metadata:
+                # Batch options, WD/CLIP models and the tag vocabulary are in the sidecar
+                try:
+                    if self.compact_metadata_writer is None:
+                        self.compact_metadata_writer = CompactMetadataWriter(getattr(p, "outpath_samples", None) or "extensions/sd-Img2img-batch-interrogator/metadata")
+                    p.extra_generation_params["Img2img batch interrogation"] = self.compact_metadata_writer.encode(config, final_tags, rating)
+                except Exception as error:
+                    print(f"[{NAME} ERROR]: Error writing compact metadata, saving the full interrogation instead: {error}")
+                    compact_metadata = False
+            if not compact_metadata:
+                p.extra_generation_params["\nImg2img batch interrogation result"] = interrogation_result
 
-            if self.wd_ext_utils is not None:
-                p.extra_generation_params["Img2img batch WD model"] = ", ".join(wd_ext_model) if wd_ext_model else None
-                p.extra_generation_params["Img2img batch WD threshold"] = wd_threshold
-                p.extra_generation_params["Img2img batch WD Ratings"] = rating if rating else None
+                if self.wd_ext_utils is not None:
+                    p.extra_generation_params["Img2img batch WD model"] = ", ".join(wd_ext_model) if wd_ext_model else None
+                    p.extra_generation_params["Img2img batch WD threshold"] = wd_threshold
+                    p.extra_generation_params["Img2img batch WD Ratings"] = rating if rating else None
 
-            if self.clip_ext is not None:
-                p.extra_generation_params["Img2img batch CLIP model"] = ", ".join(clip_ext_model) if clip_ext_model else None
-                p.extra_generation_params["Img2img batch CLIP mode"] = clip_ext_mode
+                if self.clip_ext is not None:
+                    p.extra_generation_params["Img2img batch CLIP model"] = ", ".join(clip_ext_model) if clip_ext_model else None
+                    p.extra_generation_params["Img2img batch CLIP mode"] = clip_ext_mode
+
+            if delta_note is not None:
+                p.extra_generation_params["Img2img batch tag-delta"] = delta_note
+            
+            if save_provenance:
+                p.extra_generation_params["Img2img batch tag provenance"] = json.dumps(raw_interrogation.provenance(final_tags), separators=(",", ":"), ensure_ascii=False)
 
             if not update_p:
                 p.prompt = original_prompt
@@ -1029,13 +2810,402 @@ class InterrogationProcessor:
                     p.init_images[0] = original_image
                 return result_prompt
         
+# Queue of interrogation jobs submitted through the HTTP API. A single worker thread drains the queue,
+# jobs waiting at the same time with identical options are merged into one interrogate_many call.
+class InterrogationJobQueue:
+    def __init__(self, processor, max_batch_images=32, max_finished_jobs=100):
+        self.processor = processor
+        self.max_batch_images = max_batch_images
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.condition = threading.Condition()
+        self.worker = None
+    
+    # Adds a job, sources are ("base64", data) or ("path", path) tuples, returns the job id
+    def submit(self, sources, config):
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "total": len(sources),
+            "sources": list(sources),
+            "config": config,
+            "results": [None] * len(sources),
+            "completed": 0,
+            "finished_at": None,
+            "cancel": threading.Event(),
+        }
+        with self.condition:
+            self.jobs[job_id] = job
+            self.trim_finished_jobs()
+        self.pending.put(job)
+        self.ensure_worker()
+        return job_id
+    
+    # Public view of a job, None if the id is unknown
+    def status(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return {**{key: job[key] for key in ("job_id", "status", "total", "completed")}, "cancelled": job["cancel"].is_set()}
+    
+    # Stops a job, images not interrogated yet get a "Cancelled" error. Returns False if the id is unknown
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+            job["cancel"].set()
+            return True
+    
+    # Yields result dicts in input order as they become available, ends when the job is finished
+    def iter_results(self, job_id):
+        index = 0
+        while True:
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return
+                while index < job["total"] and job["results"][index] is None and job["status"] != "done":
+                    self.condition.wait(timeout=1.0)
+                ready = []
+                while index < job["total"] and job["results"][index] is not None:
+                    ready.append(job["results"][index])
+                    index += 1
+                finished = job["status"] == "done"
+            for result in ready:
+                yield result
+            if index >= job["total"] or (finished and not ready):
+                return
+    
+    def ensure_worker(self):
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name=f"{NAME} API worker", daemon=True)
+                self.worker.start()
+    
+    # Forgets the oldest finished jobs so the job table does not grow without bound
+    def trim_finished_jobs(self):
+        finished = [job for job in self.jobs.values() if job["finished_at"] is not None]
+        if len(finished) > self.max_finished_jobs:
+            finished.sort(key=lambda job: job["finished_at"])
+            for job in finished[:len(finished) - self.max_finished_jobs]:
+                del self.jobs[job["job_id"]]
+    
+    # Loads one API image source into a reduced RGB image
+    def load_source(self, source, config):
+        kind, value = source
+        if kind == "base64":
+            if value.startswith("data:") and "," in value:
+                value = value.split(",", 1)[1]
+            value = io.BytesIO(base64.b64decode(value))
+        return load_interrogation_image(value, config.max_image_side)
+    
+    def run(self):
+        while True:
+            jobs = [self.pending.get()]
+            # Collect whatever else is already waiting so callers share one batch
+            image_count = jobs[0]["total"]
+            while image_count < self.max_batch_images:
+                try:
+                    job = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                image_count += job["total"]
+            
+            groups = {}
+            for job in jobs:
+                key = json.dumps(asdict(job["config"]), sort_keys=True, default=str)
+                groups.setdefault(key, []).append(job)
+            for group in groups.values():
+                self.run_group(group)
+    
+    # Runs all jobs sharing one config, in chunks of max_batch_images so results stream back progressively.
+    # The WebUI interrupt button does not reach API jobs, each job has its own cancel flag.
+    def run_group(self, group):
+        try:
+            self.interrogate_group(group)
+        except Exception as error:
+            # Whatever fails, the jobs finish with an error and the worker goes on with the next ones
+            print(f"[{NAME} ERROR]: API jobs failed: {error}")
+            with self.condition:
+                for job in group:
+                    for i, result in enumerate(job["results"]):
+                        if result is None:
+                            job["results"][i] = {"index": i, "error": str(error)}
+                            job["completed"] += 1
+        
+        with self.condition:
+            for job in group:
+                job["status"] = "done"
+                job["sources"] = []
+                job["finished_at"] = time.time()
+            self.condition.notify_all()
+    
+    def interrogate_group(self, group):
+        config = group[0]["config"]
+        budget = ModelTimeBudget.from_config(config)
+        items = []
+        with self.condition:
+            for job in group:
+                job["status"] = "running"
+                items.extend((job, i, source) for i, source in enumerate(job["sources"]))
+        
+        # Models stay loaded from chunk to chunk and are unloaded once after the group
+        try:
+            for start in range(0, len(items), self.max_batch_images):
+                chunk = []
+                for job, i, source in items[start:start + self.max_batch_images]:
+                    if job["cancel"].is_set():
+                        self.store_result(job, i, {"index": i, "error": "Cancelled"})
+                    else:
+                        chunk.append((job, i, source))
+                images, loaded = [], []
+                for job, i, source in chunk:
+                    try:
+                        images.append(self.load_source(source, config))
+                        loaded.append((job, i))
+                    except Exception as error:
+                        self.store_result(job, i, {"index": i, "error": f"Could not load image: {error}"})
+                # Only stop the chunk when every job in it is cancelled
+                chunk_jobs = [job for job, _ in loaded]
+                cancelled = lambda: all(job["cancel"].is_set() for job in chunk_jobs)
+                try:
+                    results = self.processor.interrogate_many(images, config, budget=budget, cancelled=cancelled, unload=False) if images else []
+                except InterrogationInterrupted:
+                    results = [None] * len(loaded)
+                    error_message = "Cancelled"
+                except Exception as error:
+                    print(f"[{NAME} ERROR]: API interrogation failed: {error}")
+                    results = [None] * len(loaded)
+                    error_message = str(error)
+                for (job, i), result in zip(loaded, results):
+                    if result is None:
+                        self.store_result(job, i, {"index": i, "error": error_message})
+                    else:
+                        self.store_result(job, i, {"index": i, "raw": result.raw, "interrogation": result.interrogation, "ratings": result.ratings, "provenance": result.provenance})
+                for image in images:
+                    image.close()
+        finally:
+            self.processor.unload_interrogators(config)
+    
+    def store_result(self, job, index, result):
+        with self.condition:
+            job["results"][index] = result
+            job["completed"] += 1
+            self.condition.notify_all()
+
+# WebUI settings for the shared micro-batching scheduler
+def on_ui_settings():
+    section = ("img2img_batch_interrogator", NAME)
+    shared.opts.add_option("img2img_batch_interrogator_scheduler", shared.OptionInfo(True, "Batch concurrent interrogation requests for the same model", section=section))
+    shared.opts.add_option("img2img_batch_interrogator_max_batch", shared.OptionInfo(8, "Interrogation scheduler max batch size", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}, section=section))
+    shared.opts.add_option("img2img_batch_interrogator_max_wait_ms", shared.OptionInfo(25, "Interrogation scheduler max wait (ms)", gr.Slider, {"minimum": 0, "maximum": 500, "step": 1}, section=section))
+    shared.opts.add_option("img2img_batch_interrogator_max_side", shared.OptionInfo(1024, "Longest image side given to the interrogators (0 = full resolution)", gr.Slider, {"minimum": 0, "maximum": 4096, "step": 64}, section=section))
+    shared.opts.add_option("img2img_batch_interrogator_clip_flavor_cache", shared.OptionInfo(True, "Use cached, batched flavor ranking for CLIP (EXT) classic/fast modes", section=section))
+    shared.opts.add_option("img2img_batch_interrogator_embedding_store", shared.OptionInfo(False, "Save CLIP (EXT) image embeddings to the on-disk embedding store", section=section))
+    shared.opts.add_option("img2img_batch_interrogator_model_budgets", shared.OptionInfo("", "Interrogator time budgets in seconds per batch/job, e.g. CLIP (EXT)=300, CLIP (Native)=120", section=section))
+    shared.opts.add_option("img2img_batch_interrogator_model_timeouts", shared.OptionInfo("", "Interrogator timeouts in seconds per image, e.g. CLIP (EXT)=20, WD (EXT)=5", section=section))
+    shared.opts.add_option("img2img_batch_interrogator_timeout_fallback", shared.OptionInfo("skip", "On interrogator timeout", gr.Radio, {"choices": list(timeout_fallbacks)}, section=section))
+    shared.opts.add_option("img2img_batch_interrogator_warmup", shared.OptionInfo(True, "Preload the selected interrogators in the background when a batch starts or the selection changes", section=section))
+    shared.opts.add_option("img2img_batch_interrogator_deepbooru_onnx_int8", shared.OptionInfo(False, "Use int8 dynamic quantization for Deepbooru (ONNX)", section=section))
+
 #Startup Callbacks
 script_callbacks.on_app_started(InterrogationProcessor.load_clip_ext_module_wrapper)
 script_callbacks.on_app_started(InterrogationProcessor.load_wd_ext_module_wrapper)
+script_callbacks.on_ui_settings(on_ui_settings)
 
 # Global interrogation processor instance for reuse by other extensions
 interrogation_processor = InterrogationProcessor()
 
+# Whether a JSON value fits an InterrogationConfig field annotation
+def matches_annotation(value, annotation):
+    origin, args = get_origin(annotation), get_args(annotation)
+    if annotation is Any:
+        return True
+    if origin is Union:
+        return any(matches_annotation(value, arg) for arg in args)
+    if annotation is type(None):
+        return value is None
+    if origin is list:
+        return isinstance(value, list) and all(matches_annotation(item, args[0]) for item in value)
+    if origin is dict:
+        return isinstance(value, dict) and all(matches_annotation(key, args[0]) and matches_annotation(item, args[1]) for key, item in value.items())
+    if annotation is float:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if annotation is int:
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, annotation)
+
+# InterrogationConfig from the `options` of an API request. Raises ValueError for unknown options, values of the
+# wrong type and settings the interrogation would reject later, so a bad request fails up front and not on the worker
+def config_from_api_options(options):
+    annotations = get_type_hints(InterrogationConfig)
+    unknown = set(options) - set(annotations)
+    if unknown:
+        raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+    wrong = [name for name, value in options.items() if not matches_annotation(value, annotations[name])]
+    if wrong:
+        raise ValueError(f"Options of the wrong type: {', '.join(f'{name} (expected {annotations[name]})' for name in sorted(wrong))}")
+    config = InterrogationConfig(**options)
+    if config.assembly_policy not in assembly_policies:
+        raise ValueError(f"Unknown assembly policy '{config.assembly_policy}', expected one of {', '.join(assembly_policies)}")
+    ModelTimeBudget.from_config(config)
+    ModelTimeouts.settings(config)
+    return config
+
+# Route dependencies requiring the --api-auth credentials, like the WebUI API itself. Empty without --api-auth
+def api_auth_dependencies():
+    api_auth = getattr(shared.cmd_opts, "api_auth", None)
+    if not api_auth:
+        return []
+    
+    from secrets import compare_digest
+    from fastapi import Depends, HTTPException
+    from fastapi.security import HTTPBasic, HTTPBasicCredentials
+
+    credentials = {}
+    for auth in api_auth.split(","):
+        user, password = auth.split(":", 1)
+        credentials[user] = password
+
+    def auth(request_credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+        if request_credentials.username in credentials:
+            if compare_digest(request_credentials.password, credentials[request_credentials.username]):
+                return True
+        raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
+
+    return [Depends(auth)]
+
+# Registers the bulk interrogation HTTP endpoints on the WebUI FastAPI app. `dependencies` apply to every route,
+# register_api_on_app_started passes the WebUI API authentication
+def register_api(app, processor=None, job_queue=None, dependencies=None):
+    from fastapi import APIRouter, HTTPException
+    from fastapi.responses import StreamingResponse
+    from pydantic import BaseModel
+
+    if job_queue is None:
+        job_queue = InterrogationJobQueue(processor or interrogation_processor)
+    
+    def request_config(options):
+        try:
+            return config_from_api_options(options)
+        except ValueError as error:
+            raise HTTPException(status_code=422, detail=str(error))
+    router = APIRouter(dependencies=dependencies or [])
+    # Cancel flags of the shard runs started here, by shard file
+    shard_runs = {}
+    shard_runs_lock = threading.Lock()
+
+    class BatchRequest(BaseModel):
+        images: List[str] = []
+        paths: List[str] = []
+        options: Dict[str, Any] = {}
+
+    @router.post("/interrogator/v1/batch")
+    def submit_batch(request: BatchRequest):
+        config = request_config(request.options)
+        if not request.images and not request.paths:
+            raise HTTPException(status_code=422, detail="No images or paths given")
+        sources = [("base64", data) for data in request.images] + [("path", path) for path in request.paths]
+        job_id = job_queue.submit(sources, config)
+        return job_queue.status(job_id)
+
+    @router.get("/interrogator/v1/jobs/{job_id}")
+    def job_status(job_id: str):
+        status = job_queue.status(job_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return status
+
+    @router.post("/interrogator/v1/jobs/{job_id}/cancel")
+    def cancel_job(job_id: str):
+        if not job_queue.cancel(job_id):
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job_queue.status(job_id)
+
+    @router.get("/interrogator/v1/jobs/{job_id}/results")
+    def job_results(job_id: str):
+        if job_queue.status(job_id) is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        lines = (json.dumps(result) + "\n" for result in job_queue.iter_results(job_id))
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    class ShardRequest(BaseModel):
+        input_dir: str
+        output_dir: str
+        shard_index: int
+        shard_count: int
+        options: Dict[str, Any] = {}
+
+    class ShardCancelRequest(BaseModel):
+        output_dir: str
+        shard_index: int
+        shard_count: int
+
+    class MergeRequest(BaseModel):
+        output_dir: str
+        require_complete: bool = True
+
+    # Runs in the background, progress is read back from the shared output folder
+    @router.post("/interrogator/v1/shards/run")
+    def run_shard(request: ShardRequest):
+        config = request_config(request.options)
+        if not 0 <= request.shard_index < request.shard_count:
+            raise HTTPException(status_code=422, detail="shard_index must be in [0, shard_count)")
+        if not os.path.isdir(request.input_dir):
+            raise HTTPException(status_code=422, detail="input_dir is not a directory")
+        shard_path = os.path.join(request.output_dir, shard_file_name(request.shard_index, request.shard_count))
+        with shard_runs_lock:
+            run = shard_runs.get(shard_path)
+            if run is not None and run[0].is_alive():
+                raise HTTPException(status_code=409, detail="Shard is already running")
+            cancel = threading.Event()
+            thread = threading.Thread(
+                target=job_queue.processor.interrogate_shard, name=f"{NAME} shard {request.shard_index}", daemon=True,
+                args=(request.input_dir, request.output_dir, request.shard_index, request.shard_count, config, cancel.is_set)
+            )
+            shard_runs[shard_path] = (thread, cancel)
+            thread.start()
+        return {"shard_file": shard_path}
+
+    # Stops a shard run after the chunk in progress, a later run resumes it
+    @router.post("/interrogator/v1/shards/cancel")
+    def cancel_shard(request: ShardCancelRequest):
+        shard_path = os.path.join(request.output_dir, shard_file_name(request.shard_index, request.shard_count))
+        with shard_runs_lock:
+            run = shard_runs.get(shard_path)
+            if run is None or not run[0].is_alive():
+                raise HTTPException(status_code=404, detail="Shard is not running")
+            run[1].set()
+        return {"shard_file": shard_path}
+
+    @router.get("/interrogator/v1/shards/status")
+    def get_shard_status(output_dir: str):
+        return shard_status(output_dir)
+
+    @router.post("/interrogator/v1/shards/merge")
+    def merge_shard_results(request: MergeRequest):
+        try:
+            return merge_shards(request.output_dir, request.require_complete)
+        except ValueError as error:
+            raise HTTPException(status_code=409, detail=str(error))
+
+    app.include_router(router)
+    return job_queue
+
+# The endpoints read and write files on the server, so like the WebUI API they only exist with --api (or
+# --nowebui) and require the --api-auth credentials when those are set
+def register_api_on_app_started(demo, app):
+    if not (getattr(shared.cmd_opts, "api", False) or getattr(shared.cmd_opts, "nowebui", False)):
+        return
+    register_api(app, dependencies=api_auth_dependencies())
+
+script_callbacks.on_app_started(register_api_on_app_started)
+
 
 class Script(scripts.ScriptBuiltinUI):
     def title(self):
@@ -1047,5 +3217,8 @@ class Script(scripts.ScriptBuiltinUI):
     def ui(self, is_img2img):
         return interrogation_processor.ui(is_img2img)
 
+    def before_process(self, p, *args, **kwargs):
+        return interrogation_processor.before_process(p, *args, **kwargs)
+
     def process_batch(self, *args, **kwargs):
         return interrogation_processor.process_batch(*args, **kwargs)
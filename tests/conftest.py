@@ -0,0 +1,300 @@
+"""
+Test harness for scripts/sd_tag_batch.py outside the WebUI.
+
+gradio and the WebUI `modules` package are replaced by small stubs before the script is imported, and the
+interrogators (Deepbooru, CLIP, clip-interrogator-ext, wd14-tagger) by deterministic stand-ins whose output
+only depends on the gray level of the image, so process_batch can be run end to end without any model.
+"""
+import importlib.util
+import os
+import re
+import sys
+import types
+
+import pytest
+from PIL import Image
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "sd_tag_batch.py")
+
+
+class _Component:
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+    @staticmethod
+    def update(*args, **kwargs):
+        return ("update", args, kwargs)
+
+
+class State:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.job = ""
+        self.job_no = 0
+        self.job_count = 1
+        self.skipped = False
+        self.interrupted = False
+
+
+def _install_stubs():
+    gradio = types.ModuleType("gradio")
+    for name in ("Accordion", "Button", "Checkbox", "Dropdown", "Group", "HighlightedText", "Radio", "Row", "Slider", "Textbox"):
+        setattr(gradio, name, _Component)
+    gradio.update = _Component.update
+    sys.modules["gradio"] = gradio
+
+    modules = types.ModuleType("modules")
+    sys.modules["modules"] = modules
+
+    def module(name, **attributes):
+        stub = types.ModuleType(f"modules.{name}")
+        stub.__dict__.update(attributes)
+        sys.modules[f"modules.{name}"] = stub
+        setattr(modules, name, stub)
+        return stub
+
+    def register(*_args, **_kwargs):
+        pass
+
+    module("scripts", ScriptBuiltinUI=object, AlwaysVisible=object())
+    module("deepbooru", model=None, re_special=re.compile(r"([\\()])"))
+    module("devices", torch_gc=lambda: None)
+    module("lowvram", send_everything_to_cpu=lambda: None)
+    module("script_callbacks", on_after_component=register, on_app_started=register, on_ui_settings=register)
+    module("shared", state=State(), interrogator=None, opts=types.SimpleNamespace(), cmd_opts=types.SimpleNamespace(api=False))
+    module("ui_components", InputAccordion=None)
+    module("processing", process_images=None)
+    module("extensions", extensions=[], list_extensions=lambda: None, active=lambda: [])
+    # Only the "resize and fill" mode the interrogators use, as a plain resize
+    module("images", resize_image=lambda resize_mode, image, width, height: image.resize((width, height)))
+
+
+def _load_script():
+    _install_stubs()
+    spec = importlib.util.spec_from_file_location("sd_tag_batch", SCRIPT_PATH)
+    script = importlib.util.module_from_spec(spec)
+    sys.modules["sd_tag_batch"] = script
+    spec.loader.exec_module(script)
+    return script
+
+
+sd_tag_batch = _load_script()
+
+
+# Gray level of a stub image, what every stand-in interrogator keys its output on
+def gray(image):
+    return image.convert("RGB").getpixel((0, 0))[0]
+
+
+def make_image(level, size=(64, 64)):
+    return Image.new("RGBA", size, (level, level, level, 255))
+
+
+class StubDeepbooru:
+    def __init__(self):
+        self.calls = []
+
+    def load(self):
+        self.calls.append("load")
+
+    def start(self):
+        self.calls.append("start")
+
+    def stop(self):
+        self.calls.append("stop")
+
+    def tag_multi(self, image):
+        return f"db {gray(image)}, 1girl, solo, looking at viewer"
+
+    def tag(self, image):
+        self.start()
+        try:
+            return self.tag_multi(image)
+        finally:
+            self.stop()
+
+
+class StubClipInterrogator:
+    def load(self):
+        pass
+
+    def interrogate(self, image):
+        return f"a photo of {gray(image)}, solo, 1girl"
+
+
+# Like the extensions, the CLIP (EXT) and WD stand-ins load their model on first use, a load is only recorded
+# when a model actually has to be loaded
+class StubClipExt:
+    def __init__(self):
+        self.calls = []
+        self.ci = None
+        self.loaded = None
+
+    def load(self, clip_model):
+        if self.loaded != clip_model:
+            self.calls.append(("load", clip_model))
+            self.loaded = clip_model
+
+    def unload(self):
+        self.calls.append(("unload",))
+        self.loaded = None
+
+    def image_to_prompt(self, image, mode, clip_model):
+        self.load(clip_model)
+        self.calls.append(("image_to_prompt", clip_model, mode))
+        return f"{clip_model} {mode} {gray(image)}, solo, masterpiece"
+
+
+class StubWdInterrogator:
+    def __init__(self):
+        self.calls = []
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.calls.append("load")
+            self.loaded = True
+
+    def unload(self):
+        self.calls.append("unload")
+        self.loaded = False
+        return True
+
+    def interrogate(self, image):
+        self.load()
+        level = gray(image)
+        ratings = {"general": 0.75, "sensitive": 0.3, "questionable": 0.05, "explicit": 0.01}
+        tags = {"1girl": 0.95, "long_hair": 0.8, f"level_{level}": 0.6, "^_^": 0.5, "smile": 0.3, "blush": 0.1}
+        return ratings, tags
+
+
+class StubWdUtils:
+    def __init__(self):
+        self.interrogators = {"wd-v1-4-vit-tagger": StubWdInterrogator()}
+
+
+# Wall-clock comparisons between backends depend on the machine and its load, they only run with --run-speed
+def pytest_addoption(parser):
+    parser.addoption("--run-speed", action="store_true", help="run the tests marked speed")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "speed: wall-clock comparison, only run with --run-speed")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-speed"):
+        return
+    skip = pytest.mark.skip(reason="wall-clock comparison, run with --run-speed")
+    for item in items:
+        if "speed" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def script():
+    return sd_tag_batch
+
+
+@pytest.fixture
+def state():
+    sd_tag_batch.state.reset()
+    yield sd_tag_batch.state
+    sd_tag_batch.state.reset()
+
+
+@pytest.fixture
+def opts(monkeypatch):
+    # Scheduler, warm-up and the on-disk caches off, so every interrogator runs inline on the calling thread
+    settings = types.SimpleNamespace(
+        img2img_batch_interrogator_scheduler=False,
+        img2img_batch_interrogator_warmup=False,
+        img2img_batch_interrogator_clip_flavor_cache=False,
+        img2img_batch_interrogator_embedding_store=False,
+        img2img_batch_interrogator_max_side=1024,
+        img2img_batch_interrogator_model_budgets="",
+        img2img_batch_interrogator_model_timeouts="",
+        img2img_batch_interrogator_timeout_fallback="skip",
+    )
+    monkeypatch.setattr(sd_tag_batch.shared, "opts", settings)
+    return settings
+
+
+@pytest.fixture
+def processor(monkeypatch, state, opts):
+    monkeypatch.setattr(sd_tag_batch.deepbooru, "model", StubDeepbooru())
+    monkeypatch.setattr(sd_tag_batch.shared, "interrogator", StubClipInterrogator())
+    # Insert at index needs the captured prompt components
+    monkeypatch.setattr(sd_tag_batch, "img2img_prompt_comp", object())
+    monkeypatch.setattr(sd_tag_batch, "img2img_neg_prompt_comp", object())
+    monkeypatch.setattr(sd_tag_batch, "custom_interrogators", {})
+    monkeypatch.setattr(sd_tag_batch.InterrogationProcessor, "tag_statistics_path", os.devnull)
+    processor = sd_tag_batch.InterrogationProcessor()
+    processor.clip_ext = StubClipExt()
+    processor.wd_ext_utils = StubWdUtils()
+    processor.model_name_to_key = {"WD14 ViT v1": "wd-v1-4-vit-tagger"}
+    return processor
+
+
+class P:
+    def __init__(self, prompt, negative_prompt, image):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.init_images = [image]
+        self.all_prompts = [prompt]
+        self.all_negative_prompts = [negative_prompt]
+        self.extra_generation_params = {}
+
+
+# The process_batch arguments plugins have always passed, with the img2img UI defaults, only the interrogators differ
+BASE_ARGUMENTS = dict(
+    tag_batch_enabled=True, model_selection=["Deepbooru (Native)"], debug_mode=False, in_front="Prepend to prompt",
+    insert_target="Prompt", insert_index=0, prompt_weight_mode=True, prompt_weight=0.5, reverse_mode=False,
+    exaggeration_mode=False, prompt_output=False, use_positive_filter=False, use_negative_filter=False,
+    use_custom_filter=False, custom_filter="", use_custom_replace=False, custom_replace_find="",
+    custom_replace_replacements="", clip_ext_model=["ViT-L-14/openai"], clip_ext_mode="best",
+    wd_ext_model=["WD14 ViT v1"], wd_threshold=0.35, wd_underscore_fix=True, wd_append_ratings=False, wd_ratings=0.5,
+    wd_keep_tags="", unload_clip_models_afterwords=True, unload_wd_models_afterwords=True, no_puncuation_mode=False,
+)
+
+# Arguments added to the img2img UI since, with their UI defaults, in UI order
+UI_ARGUMENTS = dict(
+    tag_delta_mode=False, tag_delta_tolerance=0.02, tag_stats_mode=False, assembly_policy="keep-first", model_priority="",
+    max_tags=0, save_provenance=False, compact_metadata=False,
+)
+
+
+@pytest.fixture
+def run_batch(processor, state):
+    """
+    Runs an img2img batch through process_batch, one call per image with the UI values as positional arguments
+    like the WebUI does, and returns what each call left in p: prompt, negative prompt, the parsed prompt handed to
+    the model and the generation parameters. `outpath_samples` is the img2img output folder.
+    """
+    def run(images, prompt="", negative_prompt="", outpath_samples=None, **arguments):
+        ui_values = {**BASE_ARGUMENTS, **UI_ARGUMENTS}
+        assert set(arguments) <= set(ui_values)
+        ui_values.update(arguments)
+        p = P(prompt, negative_prompt, images[0])
+        if outpath_samples is not None:
+            p.outpath_samples = outpath_samples
+        state.job_count = len(images)
+        outputs = []
+        for job_no, image in enumerate(images):
+            state.job_no = job_no
+            p.init_images[0] = image
+            p.extra_generation_params = {}
+            prompts = [p.prompt]
+            processor.process_batch(p, *ui_values.values(), batch_number=0, prompts=prompts, seeds=[1], subseeds=[1])
+            outputs.append({
+                "prompt": p.prompt,
+                "negative_prompt": p.negative_prompt,
+                "prompts": prompts[0],
+                "all_negative_prompts": p.all_negative_prompts[0],
+                "params": dict(p.extra_generation_params),
+            })
+        return outputs
+    return run
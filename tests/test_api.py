@@ -0,0 +1,191 @@
+"""
+The HTTP API: registration behind --api and --api-auth, and API jobs and shard runs leaving the WebUI job state alone.
+"""
+import base64
+import io
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from conftest import gray, make_image, sd_tag_batch
+
+
+@pytest.fixture
+def cmd_opts(monkeypatch):
+    cmd_opts = sd_tag_batch.shared.cmd_opts
+    monkeypatch.setattr(cmd_opts, "api", False, raising=False)
+    monkeypatch.setattr(cmd_opts, "nowebui", False, raising=False)
+    monkeypatch.setattr(cmd_opts, "api_auth", None, raising=False)
+    return cmd_opts
+
+
+def routes(app):
+    return [path for path in app.openapi()["paths"] if path.startswith("/interrogator/")]
+
+
+def encode(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def gray_tagger(processor, state):
+    sd_tag_batch.register_interrogator("Gray Tagger", lambda images: [f"gray {gray(image)}" for image in images], tier=0)
+    yield
+    sd_tag_batch.unregister_interrogator("Gray Tagger")
+
+
+def test_routes_need_api_flag(cmd_opts):
+    app = FastAPI()
+    sd_tag_batch.register_api_on_app_started(None, app)
+    assert routes(app) == []
+
+    cmd_opts.api = True
+    app = FastAPI()
+    sd_tag_batch.register_api_on_app_started(None, app)
+    assert "/interrogator/v1/batch" in routes(app)
+    assert "/interrogator/v1/shards/run" in routes(app)
+
+
+def test_routes_use_api_auth(cmd_opts):
+    cmd_opts.api = True
+    cmd_opts.api_auth = "alice:secret,bob:hunter2"
+    app = FastAPI()
+    sd_tag_batch.register_api_on_app_started(None, app)
+    client = TestClient(app)
+
+    response = client.get("/interrogator/v1/shards/status", params={"output_dir": "."})
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Basic"
+    assert client.get("/interrogator/v1/shards/status", params={"output_dir": "."}, auth=("alice", "wrong")).status_code == 401
+    assert client.get("/interrogator/v1/shards/status", params={"output_dir": "."}, auth=("bob", "hunter2")).status_code == 200
+
+
+def test_api_job_ignores_webui_interrupt(processor, gray_tagger, state):
+    app = FastAPI()
+    sd_tag_batch.register_api(app, processor)
+    client = TestClient(app)
+    # The WebUI job was interrupted, the API job runs anyway and the flag stays for the WebUI job
+    state.interrupted = True
+    state.skipped = True
+    job = client.post("/interrogator/v1/batch", json={"images": [encode(make_image(10)), encode(make_image(20))], "options": {"model_selection": ["Gray Tagger"]}}).json()
+    lines = [json.loads(line) for line in client.get(f"/interrogator/v1/jobs/{job['job_id']}/results").text.splitlines()]
+    assert [line["interrogation"] for line in lines] == ["gray 10", "gray 20"]
+    assert state.interrupted and state.skipped
+
+
+def test_cancelled_job_stops(processor, state):
+    started, release = threading.Event(), threading.Event()
+
+    def hang(images):
+        started.set()
+        release.wait(5)
+        return ["late"] * len(images)
+
+    sd_tag_batch.register_interrogator("Hanging Tagger", hang, tier=0)
+    sd_tag_batch.register_interrogator("Slow Tagger", lambda images: ["slow"] * len(images), tier=3)
+    job_queue = sd_tag_batch.InterrogationJobQueue(processor, max_batch_images=1)
+    app = FastAPI()
+    sd_tag_batch.register_api(app, job_queue=job_queue)
+    client = TestClient(app)
+
+    options = {"model_selection": ["Hanging Tagger", "Slow Tagger"]}
+    job = client.post("/interrogator/v1/batch", json={"images": [encode(make_image(10)), encode(make_image(20))], "options": options}).json()
+    assert started.wait(5)
+    assert client.post(f"/interrogator/v1/jobs/{job['job_id']}/cancel").json()["cancelled"]
+    release.set()
+    lines = [json.loads(line) for line in client.get(f"/interrogator/v1/jobs/{job['job_id']}/results").text.splitlines()]
+    assert lines == [{"index": 0, "error": "Cancelled"}, {"index": 1, "error": "Cancelled"}]
+    assert client.post("/interrogator/v1/jobs/unknown/cancel").status_code == 404
+    assert not state.interrupted
+
+
+def test_shard_run_ignores_webui_interrupt(processor, gray_tagger, state, tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for level in range(3):
+        make_image(level * 10).save(input_dir / f"{level}.png")
+    state.interrupted = True
+    result = processor.interrogate_shard(str(input_dir), str(tmp_path / "out"), 0, 1, sd_tag_batch.InterrogationConfig(model_selection=["Gray Tagger"]), cancelled=lambda: False)
+    assert result["done"] and result["completed"] == 3
+    assert state.interrupted
+
+
+@pytest.mark.parametrize("options, message", [
+    ({"model_time_budgets": {"CLIP (EXT)": "abc"}}, "model_time_budgets"),
+    ({"model_selection": "Deepbooru (Native)"}, "model_selection"),
+    ({"max_tags": "10"}, "max_tags"),
+    ({"timeout_fallback": "retry"}, "Unknown timeout fallback"),
+    ({"assembly_policy": "random"}, "Unknown assembly policy"),
+    ({"no_such_option": True}, "Unknown options"),
+])
+def test_bad_options_are_rejected_on_submit(processor, options, message, tmp_path):
+    app = FastAPI()
+    sd_tag_batch.register_api(app, processor)
+    client = TestClient(app)
+    response = client.post("/interrogator/v1/batch", json={"images": [encode(make_image(10))], "options": options})
+    assert response.status_code == 422
+    assert message in response.json()["detail"]
+    shard = {"input_dir": str(tmp_path), "output_dir": str(tmp_path / "out"), "shard_index": 0, "shard_count": 1, "options": options}
+    assert client.post("/interrogator/v1/shards/run", json=shard).status_code == 422
+
+
+def test_failing_group_does_not_stop_the_worker(processor, gray_tagger):
+    job_queue = sd_tag_batch.InterrogationJobQueue(processor)
+    # A config the API would reject, straight into the queue
+    broken = job_queue.submit([("base64", encode(make_image(10)))], sd_tag_batch.InterrogationConfig(model_selection=["Gray Tagger"], model_time_budgets={"Gray Tagger": "abc"}))
+    assert list(job_queue.iter_results(broken)) == [{"index": 0, "error": "could not convert string to float: 'abc'"}]
+    assert job_queue.status(broken)["status"] == "done"
+
+    working = job_queue.submit([("base64", encode(make_image(20)))], sd_tag_batch.InterrogationConfig(model_selection=["Gray Tagger"]))
+    assert [result["interrogation"] for result in job_queue.iter_results(working)] == ["gray 20"]
+
+
+class WebUIJobClipExt:
+    """clip-interrogator-ext as far as shared.state goes: each call begins and ends a WebUI job of its own."""
+
+    def __init__(self, state, release):
+        self.state = state
+        self.release = release
+        self.started = threading.Event()
+
+    def load(self, clip_model):
+        pass
+
+    def unload(self):
+        pass
+
+    def image_to_prompt(self, image, mode, clip_model):
+        self.state.job, self.state.job_no, self.state.job_count = "interrogate", 0, -1
+        self.state.interrupted = self.state.skipped = False
+        self.started.set()
+        self.release.wait(5)
+        self.state.job = ""
+        return f"clip {gray(image)}"
+
+
+def test_background_clip_ext_keeps_webui_job_state(processor, state):
+    release = threading.Event()
+    processor.clip_ext = WebUIJobClipExt(state, release)
+    # An img2img batch is at its fourth image and the user already pressed Skip
+    state.job, state.job_no, state.job_count, state.skipped = "img2img", 3, 5, True
+    config = sd_tag_batch.InterrogationConfig(model_selection=["CLIP (EXT)"])
+    results = []
+    worker = threading.Thread(target=lambda: results.extend(processor.interrogate_many([make_image(10)], config, cancelled=lambda: False)))
+    worker.start()
+    assert processor.clip_ext.started.wait(5)
+    # Interrupt pressed while the API job is in the ext call
+    state.interrupted = True
+    release.set()
+    worker.join(5)
+
+    assert [result.raw for result in results] == ["clip 10"]
+    assert (state.job, state.job_no, state.job_count) == ("img2img", 3, 5)
+    assert state.interrupted and state.skipped
@@ -0,0 +1,112 @@
+"""
+Benchmarks of the string pipeline that runs for every image of a batch: deduplication, find & replace, the prompt
+filters, punctuation removal and prompt splicing. Each case fails when its mean time goes over a threshold set
+roughly ten times above what a laptop needs, so only real regressions trip it.
+
+    python -m pytest tests/test_benchmarks.py --benchmark-only
+"""
+import random
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from conftest import sd_tag_batch
+
+# A large interrogation: four models of 60 tags each with the overlap real taggers have
+random.seed(0)
+VOCABULARY = [f"tag {i}" for i in range(150)] + ["(detailed:1.2)", "1girl", "solo", "looking at viewer", "o_o", "smile :)"]
+MODEL_OUTPUTS = [", ".join(random.sample(VOCABULARY, 60)) for _ in range(4)]
+RAW_INTERROGATION = ", ".join(MODEL_OUTPUTS) + ", "
+PROMPT = ", ".join(random.sample(VOCABULARY, 30))
+NEGATIVE_PROMPT = ", ".join(random.sample(VOCABULARY, 30))
+CUSTOM_FILTER = ", ".join(random.sample(VOCABULARY, 20))
+REPLACE_FIND = ", ".join(f"tag {i}" for i in range(0, 150, 10))
+REPLACE_WITH = ", ".join(f"word {i}" for i in range(0, 150, 10))
+
+
+def assert_mean_below(benchmark, seconds):
+    # No stats when benchmarks are disabled (--benchmark-disable), the case then only checks that the code runs
+    if benchmark.stats is not None:
+        assert benchmark.stats.stats.mean < seconds
+
+
+@pytest.fixture
+def pipeline_processor():
+    return sd_tag_batch.InterrogationProcessor()
+
+
+def full_config(**options):
+    return sd_tag_batch.InterrogationConfig(
+        use_positive_filter=True, use_negative_filter=True, use_custom_filter=True, custom_filter=CUSTOM_FILTER,
+        use_custom_replace=True, custom_replace_find=REPLACE_FIND, custom_replace_replacements=REPLACE_WITH,
+        no_puncuation_mode=True, prompt_weight_mode=True, prompt=PROMPT, negative_prompt=NEGATIVE_PROMPT, **options
+    )
+
+
+def test_clean_string(benchmark, pipeline_processor):
+    result = benchmark(pipeline_processor.clean_string, RAW_INTERROGATION)
+    assert result.count(",") < RAW_INTERROGATION.count(",")
+    assert_mean_below(benchmark, 0.002)
+
+
+def test_assemble_keep_first(benchmark, pipeline_processor):
+    def assemble():
+        assembly = sd_tag_batch.TagAssembly()
+        for i, output in enumerate(MODEL_OUTPUTS):
+            assembly.add(f"model {i}", output)
+        return assembly.assemble("keep-first")
+
+    result = benchmark(assemble)
+    # keep-first is the deduplication of clean_string
+    assert result == pipeline_processor.clean_string(RAW_INTERROGATION)
+    assert_mean_below(benchmark, 0.005)
+
+
+def test_assemble_highest_confidence(benchmark):
+    def assemble():
+        assembly = sd_tag_batch.TagAssembly()
+        for i, output in enumerate(MODEL_OUTPUTS):
+            assembly.add(f"model {i}", output, {tag: (i + 1) / 10 for tag in output.split(", ")})
+        return assembly.assemble("highest-confidence", max_tags=75)
+
+    result = benchmark(assemble)
+    assert len(result.split(", ")) == 75
+    assert_mean_below(benchmark, 0.01)
+
+
+def test_filter_words(benchmark, pipeline_processor):
+    benchmark(pipeline_processor.filter_words, RAW_INTERROGATION, NEGATIVE_PROMPT)
+    assert_mean_below(benchmark, 0.02)
+
+
+def test_custom_replace(benchmark, pipeline_processor):
+    pairs = pipeline_processor.parse_replace_pairs(REPLACE_FIND, REPLACE_WITH)
+    result = benchmark(pipeline_processor.custom_replace, RAW_INTERROGATION, pairs)
+    assert "word 10" in result
+    assert_mean_below(benchmark, 0.01)
+
+
+def test_remove_punctuation(benchmark, pipeline_processor):
+    benchmark(pipeline_processor.remove_punctuation, RAW_INTERROGATION)
+    assert_mean_below(benchmark, 0.01)
+
+
+def test_postprocess_interrogation(benchmark, pipeline_processor):
+    config = full_config()
+    result = benchmark(pipeline_processor.postprocess_interrogation, RAW_INTERROGATION, config)
+    assert result.startswith("(") and result.endswith(":0.5), ")
+    assert_mean_below(benchmark, 0.05)
+
+
+def test_postprocess_interrogation_with_statistics(benchmark, pipeline_processor):
+    config = full_config()
+    benchmark(lambda: pipeline_processor.postprocess_interrogation(RAW_INTERROGATION, config, sd_tag_batch.TagStatistics()))
+    assert_mean_below(benchmark, 0.06)
+
+
+def test_splice_prompt(benchmark):
+    prompt = ", ".join(f"(tag {i}, detail:1.1)" if i % 7 == 0 else f"tag {i}" for i in range(100)) + ", <lora:style:0.7>"
+    result = benchmark(lambda: sd_tag_batch.parse_prompt(prompt).splice(50, "interrogation"))
+    assert "interrogation" in result
+    assert_mean_below(benchmark, 0.005)
@@ -0,0 +1,166 @@
+"""
+Deepbooru (ONNX) against Deepbooru (Native): a small torch model with the DeepDanbooru interface (NHWC input,
+`tags` attribute) stands in for the real one, it is exported, optionally quantized, and both backends tag the same
+images. Tags may only differ where the native probability is within a tolerance of the threshold. With --run-speed
+the batched float32 ONNX run may also not be slower than the native model tagging one image at a time.
+"""
+import random
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnxruntime")
+
+from conftest import sd_tag_batch
+
+THRESHOLD = 0.5
+# ONNX time over native time. On a single CPU core batched ONNX takes 0.8-0.95 of the native time, the margin covers
+# timing noise; with more cores the gap grows
+MAX_SPEED_RATIO = 1.1
+TAGS = [f"tag_{i}" for i in range(60)] + ["rating:safe", "rating:explicit", "long_hair", "smile_(expression)", "^_^"]
+
+
+class TinyDeepDanbooru(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        # A few strided convolutions so inference, not preprocessing, dominates like in the real ResNet
+        self.features = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 32, 3, stride=2, padding=1), torch.nn.ReLU(),
+            torch.nn.Conv2d(32, 64, 3, stride=2, padding=1), torch.nn.ReLU(),
+            torch.nn.Conv2d(64, 64, 3, padding=1), torch.nn.ReLU(),
+            torch.nn.Conv2d(64, 128, 3, stride=2, padding=1), torch.nn.ReLU(),
+            torch.nn.Conv2d(128, 128, 3, stride=2, padding=1), torch.nn.ReLU(),
+        )
+        self.head = torch.nn.Linear(128, len(TAGS))
+        # Spread the probabilities so most tags are clearly on one side of the threshold
+        with torch.no_grad():
+            self.head.weight.mul_(8)
+        self.tags = list(TAGS)
+
+    def forward(self, x):
+        x = x.permute(0, 3, 1, 2)
+        x = self.features(x).mean(dim=(2, 3))
+        return torch.sigmoid(self.head(x))
+
+
+# modules.deepbooru.DeepDanbooru as far as the interrogator uses it, tagging with the torch model
+class TorchDeepbooru:
+    def __init__(self):
+        self.model = TinyDeepDanbooru().eval()
+
+    def load(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def probabilities(self, image):
+        from modules import images
+        pic = images.resize_image(2, image.convert("RGB"), 512, 512)
+        a = np.expand_dims(np.array(pic, dtype=np.float32), 0) / 255
+        with torch.no_grad():
+            return self.model(torch.from_numpy(a))[0].numpy()
+
+    def tag_multi(self, image):
+        opts = sd_tag_batch.shared.opts
+        probability_dict = {tag: probability for tag, probability in zip(self.model.tags, self.probabilities(image)) if probability >= opts.interrogate_deepbooru_score_threshold and not tag.startswith("rating:")}
+        tags = [tag for tag, _ in sorted(probability_dict.items(), key=lambda x: -x[1])]
+        return ", ".join(sd_tag_batch.re.sub(sd_tag_batch.deepbooru.re_special, r"\\\1", tag.replace("_", " ")) for tag in tags)
+
+
+@pytest.fixture
+def native(monkeypatch, opts):
+    opts.interrogate_deepbooru_score_threshold = THRESHOLD
+    opts.deepbooru_sort_alpha = False
+    opts.deepbooru_filter_tags = ""
+    opts.deepbooru_use_spaces = True
+    opts.deepbooru_escape = True
+    opts.interrogate_return_ranks = False
+    model = TorchDeepbooru()
+    monkeypatch.setattr(sd_tag_batch.deepbooru, "model", model)
+    return model
+
+
+@pytest.fixture
+def onnx(monkeypatch, tmp_path):
+    monkeypatch.setattr(sd_tag_batch.DeepbooruOnnx, "model_dir", str(tmp_path))
+    return sd_tag_batch.DeepbooruOnnx()
+
+
+def noise_images(count):
+    random.seed(0)
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(count):
+        size = (random.randint(256, 768), random.randint(256, 768))
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        images.append(Image.fromarray(pixels, "RGB"))
+    return images
+
+
+def split_tags(text):
+    return [tag.strip() for tag in text.split(",") if tag.strip()]
+
+
+@pytest.mark.parametrize("quantize, tolerance", [(False, 1e-3), (True, 0.05)])
+def test_onnx_tags_match_native(native, onnx, quantize, tolerance):
+    images = noise_images(8)
+    probabilities = {tag: [] for tag in TAGS}
+    for image in images:
+        for tag, probability in zip(TAGS, native.probabilities(image)):
+            probabilities[tag].append(probability)
+    native_tags = [split_tags(native.tag_multi(image)) for image in images]
+    onnx_tags = [split_tags(text) for text in onnx.tag_batch(images, quantize)]
+
+    formatted = {sd_tag_batch.re.sub(sd_tag_batch.deepbooru.re_special, r"\\\1", tag.replace("_", " ")): tag for tag in TAGS}
+    for i, (expected, actual) in enumerate(zip(native_tags, onnx_tags)):
+        assert expected, "the stand-in model should produce tags"
+        for tag in set(expected) ^ set(actual):
+            assert abs(probabilities[formatted[tag]][i] - THRESHOLD) <= tolerance, f"image {i}: {tag} differs"
+        if not quantize:
+            assert [tag for tag in expected if tag in actual] == [tag for tag in actual if tag in expected]
+
+
+def test_export_writes_tags_before_model(native, onnx, monkeypatch):
+    replaced = []
+    real_replace = sd_tag_batch.os.replace
+    monkeypatch.setattr(sd_tag_batch.os, "replace", lambda source, target: (replaced.append(target), real_replace(source, target)))
+    onnx.export(False)
+    assert replaced == [f"{onnx.model_path(False)}.tags.json", onnx.model_path(False)]
+
+
+def test_export_repeats_when_tags_are_missing(native, onnx):
+    onnx.export(False)
+    sd_tag_batch.os.remove(f"{onnx.model_path(False)}.tags.json")
+    onnx.export(False)
+    session, tags = onnx.session(False)
+    assert tags == TAGS
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+# Batched float32 ONNX against the native model one image at a time, as Deepbooru (Native) runs. The int8 export is
+# not held to this: dynamic quantization turns convolutions into ConvInteger, which is slower on many CPUs.
+@pytest.mark.speed
+def test_onnx_is_not_slower_than_native(native, onnx):
+    images = noise_images(16)
+    # Export and session creation happen once, outside the timing
+    onnx.tag_batch(images[:1], False)
+    native.tag_multi(images[0])
+
+    # Alternating runs so drifts in machine load hit both sides alike, best of each
+    runs = [(timed(lambda: [native.tag_multi(image) for image in images]), timed(lambda: onnx.tag_batch(images, False))) for _ in range(5)]
+    native_seconds = min(native for native, _ in runs)
+    onnx_seconds = min(onnx for _, onnx in runs)
+    assert onnx_seconds / native_seconds < MAX_SPEED_RATIO, f"native {native_seconds:.3f}s, onnx {onnx_seconds:.3f}s"
@@ -0,0 +1,41 @@
+"""
+ImageEmbeddingStore recovery from appends interrupted between the data and the index write.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from conftest import sd_tag_batch
+
+
+def vector(value, dim=4):
+    return np.full((1, dim), value, dtype=np.float32)
+
+
+def test_crash_before_first_index_write(tmp_path):
+    store = sd_tag_batch.ImageEmbeddingStore(str(tmp_path))
+    store.add(["h0"], vector(0.25))
+    # The first append wrote meta.json and the data row, the index was never written
+    os.remove(store.index_path)
+
+    store = sd_tag_batch.ImageEmbeddingStore(str(tmp_path))
+    assert len(store) == 0
+    store.add(["h1"], vector(0.5))
+    assert "h0" not in store
+    assert np.allclose(store.get("h1"), 0.5)
+    assert np.allclose(sd_tag_batch.ImageEmbeddingStore(str(tmp_path)).get("h1"), 0.5)
+
+
+@pytest.mark.parametrize("extra_bytes", [2, 8])
+def test_crash_after_data_append(tmp_path, extra_bytes):
+    store = sd_tag_batch.ImageEmbeddingStore(str(tmp_path))
+    store.add(["h0", "h1"], np.concatenate([vector(0.25), vector(0.5)]))
+    # A later append died after writing part of or a whole row, before its index line
+    with open(store.data_path, "ab") as file:
+        file.write(b"\0" * extra_bytes)
+
+    store = sd_tag_batch.ImageEmbeddingStore(str(tmp_path))
+    assert len(store) == 2
+    store.add(["h2"], vector(0.75))
+    assert [float(store.get(hash_value)[0]) for hash_value in ("h0", "h1", "h2")] == [0.25, 0.5, 0.75]
@@ -0,0 +1,196 @@
+"""
+Pins the prompts process_batch produces for the img2img batch options, with the stand-in interrogators of conftest.
+The expected outputs in golden/process_batch.json were recorded from the extension before the batched
+interrogation pipeline and must not change unless a request changes the prompt construction on purpose.
+"""
+import json
+import os
+import re
+
+import pytest
+
+from conftest import gray, make_image, sd_tag_batch
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden", "process_batch.json")
+
+ALL_MODELS = ["Deepbooru (Native)", "CLIP (Native)", "WD (EXT)", "CLIP (EXT)"]
+
+# name: (gray levels of the batch images, prompt, negative prompt, process_batch options)
+CASES = {
+    "prepend": ([10, 20], "masterpiece, best quality", "lowres", {}),
+    "prepend_unweighted": ([10, 20], "masterpiece, best quality", "lowres", {"prompt_weight_mode": False}),
+    "empty_prompt": ([10, 20], "", "lowres", {}),
+    "append": ([10, 20], "masterpiece, best quality", "lowres", {"in_front": "Append to prompt"}),
+    "append_unweighted": ([10, 20], "masterpiece, best quality", "lowres", {"in_front": "Append to prompt", "prompt_weight_mode": False}),
+    "insert_prompt": ([10, 20], "a, b, c", "lowres, blurry", {"in_front": "Insert at index", "insert_index": 1}),
+    "insert_prompt_clamped": ([10], "a, b, c", "lowres", {"in_front": "Insert at index", "insert_index": 9}),
+    "insert_negative": ([10, 20], "a, b, c", "lowres, blurry", {"in_front": "Insert at index", "insert_target": "Negative prompt", "insert_index": 1}),
+    "reverse": ([10, 20], "masterpiece", "lowres", {"reverse_mode": True}),
+    "reverse_append": ([10, 20], "masterpiece", "lowres", {"reverse_mode": True, "in_front": "Append to prompt"}),
+    "weight": ([10], "masterpiece", "lowres", {"prompt_weight": 1.3}),
+    "all_models": ([10, 20], "masterpiece", "lowres", {"model_selection": ALL_MODELS}),
+    "all_models_reordered": ([10], "masterpiece", "lowres", {"model_selection": list(reversed(ALL_MODELS))}),
+    "exaggeration": ([10, 20], "masterpiece", "lowres", {"model_selection": ALL_MODELS, "exaggeration_mode": True}),
+    "wd_ratings": ([10], "masterpiece", "lowres", {"model_selection": ["WD (EXT)"], "wd_append_ratings": True, "wd_ratings": 0.25}),
+    "wd_ratings_too_high": ([10], "masterpiece", "lowres", {"model_selection": ["WD (EXT)"], "wd_append_ratings": True, "wd_ratings": 0.9}),
+    "wd_keep_tags": ([10], "masterpiece", "lowres", {"model_selection": ["WD (EXT)"], "wd_keep_tags": "blush, long hair, missing"}),
+    "wd_underscores": ([10], "masterpiece", "lowres", {"model_selection": ["WD (EXT)"], "wd_underscore_fix": False, "wd_threshold": 0.2}),
+    "positive_filter": ([10, 20], "solo, masterpiece", "lowres", {"model_selection": ALL_MODELS, "use_positive_filter": True}),
+    "negative_filter": ([10, 20], "masterpiece", "1girl, (solo:1.2)", {"model_selection": ALL_MODELS, "use_negative_filter": True}),
+    "custom_filter": ([10], "masterpiece", "lowres", {"model_selection": ALL_MODELS, "use_custom_filter": True, "custom_filter": "looking at viewer, smile"}),
+    "custom_replace": ([10], "masterpiece", "lowres", {"model_selection": ALL_MODELS, "use_custom_replace": True, "custom_replace_find": "1girl, solo", "custom_replace_replacements": "1woman, alone"}),
+    "no_punctuation": ([10], "masterpiece", "lowres", {"model_selection": ["WD (EXT)"], "no_puncuation_mode": True, "wd_threshold": 0.2}),
+    "extra_networks": ([10], "<lora:detail:0.5>, masterpiece", "lowres", {}),
+}
+
+
+def load_golden():
+    with open(GOLDEN_PATH, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_process_batch_matches_golden(name, run_batch):
+    levels, prompt, negative_prompt, options = CASES[name]
+    outputs = run_batch([make_image(level) for level in levels], prompt, negative_prompt, **options)
+    # Round trip through JSON so the WD ratings compare like the recorded ones
+    assert json.loads(json.dumps(outputs)) == load_golden()[name]
+
+
+def test_golden_covers_every_case():
+    assert sorted(load_golden()) == sorted(CASES)
+
+
+def test_disabled_leaves_p_untouched(run_batch):
+    outputs = run_batch([make_image(10)], "masterpiece", "lowres", tag_batch_enabled=False)
+    assert outputs == [{"prompt": "masterpiece", "negative_prompt": "lowres", "prompts": "masterpiece", "all_negative_prompts": "lowres", "params": {}}]
+
+
+def test_update_p_false_returns_prompt_and_restores_p(processor, state):
+    from conftest import BASE_ARGUMENTS, P
+
+    image = make_image(10)
+    p = P("masterpiece", "lowres", image)
+    result = processor.process_batch(p, **BASE_ARGUMENTS, batch_number=0, prompts=[p.prompt], seeds=[1], subseeds=[1], update_p=False)
+    assert result == "(db 10, 1girl, solo, looking at viewer:0.5), masterpiece"
+    assert (p.prompt, p.negative_prompt, p.init_images[0]) == ("masterpiece", "lowres", image)
+
+
+def test_plugin_call_with_keywords(processor, state):
+    from conftest import BASE_ARGUMENTS, P
+
+    # The README plugin call: no batch_number, prompts, seeds or the options added to the UI later
+    p = P("masterpiece", "lowres", make_image(10))
+    result = processor.process_batch(p=p, **BASE_ARGUMENTS, prompt_override="custom prompt", update_p=False)
+    assert result == "(db 10, 1girl, solo, looking at viewer:0.5), custom prompt"
+    assert p.prompt == "masterpiece"
+
+
+def test_interrogators_receive_rgb_copy(processor, run_batch):
+    image = make_image(10)
+    run_batch([image], "masterpiece", "lowres", model_selection=ALL_MODELS)
+    # p.init_images keeps the alpha channel, WD and CLIP (EXT) unload once per image
+    assert image.mode == "RGBA"
+    assert processor.clip_ext.calls.count(("unload",)) == 1
+    assert processor.wd_ext_utils.interrogators["wd-v1-4-vit-tagger"].calls == ["load", "unload"]
+
+
+def test_compact_metadata_header_records_webui_settings(processor, opts, tmp_path):
+    from conftest import BASE_ARGUMENTS, P
+
+    opts.img2img_batch_interrogator_max_side = 512
+    opts.img2img_batch_interrogator_model_budgets = "CLIP (EXT)=300"
+    opts.img2img_batch_interrogator_model_timeouts = "WD (EXT)=5"
+    opts.img2img_batch_interrogator_timeout_fallback = "cheaper"
+    p = P("masterpiece", "lowres", make_image(10))
+    p.outpath_samples = str(tmp_path)
+    processor.process_batch(p, **BASE_ARGUMENTS, compact_metadata=True)
+    [sidecar] = tmp_path.glob("interrogations-*.jsonl")
+    with open(sidecar, "r", encoding="utf-8") as file:
+        header = json.loads(file.readline())["header"]
+    assert header["max_image_side"] == 512
+    assert header["model_time_budgets"] == {"CLIP (EXT)": 300.0}
+    assert header["model_timeouts"] == {"WD (EXT)": 5.0}
+    assert header["timeout_fallback"] == "cheaper"
+
+
+# Infotext as the WebUI writes it: values containing ":" are JSON-quoted
+def save_with_parameters(path, params):
+    from PIL.PngImagePlugin import PngInfo
+
+    info = PngInfo()
+    info.add_text("parameters", ", ".join(f"{key.strip()}: {json.dumps(value) if ':' in str(value) else value}" for key, value in params.items()))
+    make_image(0).save(path, pnginfo=info)
+
+
+def read_compact_value(path):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        parameters = image.text["parameters"]
+    return json.loads(re.search(r'Img2img batch interrogation: ("(?:\\.|[^"])*")', parameters).group(1))
+
+
+def test_compact_metadata_round_trip(processor, run_batch, tmp_path):
+    options = {"model_selection": ["WD (EXT)", "Deepbooru (Native)"], "wd_append_ratings": True, "wd_ratings": 0.25}
+    images = [make_image(10), make_image(20)]
+    full = run_batch(images, "masterpiece", "lowres", **options)
+
+    compact = run_batch(images, "masterpiece", "lowres", outpath_samples=str(tmp_path), compact_metadata=True, **options)
+    reader = sd_tag_batch.CompactMetadataReader(str(tmp_path))
+    for i, (full_output, compact_output) in enumerate(zip(full, compact)):
+        path = tmp_path / f"{i}.png"
+        save_with_parameters(path, compact_output["params"])
+        decoded = reader.decode(read_compact_value(path))
+        assert decoded["interrogation"] == full_output["params"]["\nImg2img batch interrogation result"]
+        assert decoded["ratings"] == pytest.approx(full_output["params"]["Img2img batch WD Ratings"], rel=1e-3)
+        assert decoded["header"]["wd_ratings"] == 0.25
+        assert compact_output["prompt"] == full_output["prompt"]
+
+
+def test_tag_delta_reuses_unchanged_images(processor, run_batch):
+    deepbooru = sd_tag_batch.deepbooru.model
+    outputs = run_batch([make_image(10), make_image(12), make_image(200)], "masterpiece", "lowres", tag_delta_mode=True)
+    notes = [output["params"]["Img2img batch tag-delta"] for output in outputs]
+    assert notes[0] == "interrogated (no previous image)"
+    assert notes[1].startswith("reused (difference 0.0078")
+    assert notes[2].startswith("interrogated (difference 0.74")
+    assert "db 10" in outputs[1]["prompt"]
+    assert "db 200" in outputs[2]["prompt"]
+    assert deepbooru.calls.count("start") == 2
+
+    # Changed interrogator options never reuse the previous interrogation
+    outputs = run_batch([make_image(12)], "masterpiece", "lowres", tag_delta_mode=True, wd_threshold=0.5)
+    assert outputs[0]["params"]["Img2img batch tag-delta"] == "interrogated (no previous image)"
+    assert "db 12" in outputs[0]["prompt"]
+    assert deepbooru.calls.count("start") == 3
+
+
+def test_registered_interrogator(processor, run_batch):
+    sd_tag_batch.register_interrogator("Gray Tagger", lambda images: [f"gray {gray(image)}" for image in images], tier=0)
+    assert "Gray Tagger" in processor.get_initial_model_options()
+    outputs = run_batch([make_image(10)], "masterpiece", "lowres", model_selection=["Gray Tagger", "Deepbooru (Native)"])
+    assert outputs[0]["prompt"].startswith("(gray 10, db 10, ")
+
+    sd_tag_batch.unregister_interrogator("Gray Tagger")
+    assert "Gray Tagger" not in processor.get_initial_model_options()
+    with pytest.raises(ValueError, match="built-in"):
+        sd_tag_batch.register_interrogator("WD (EXT)", lambda images: [])
+
+
+@pytest.mark.parametrize("flag", ["lowvram", "medvram"])
+def test_direct_clip_ext_use_frees_vram_first(processor, opts, monkeypatch, flag):
+    calls = processor.clip_ext.calls
+    monkeypatch.setattr(sd_tag_batch.lowvram, "send_everything_to_cpu", lambda: calls.append("send_everything_to_cpu"))
+    monkeypatch.setattr(sd_tag_batch.devices, "torch_gc", lambda: calls.append("torch_gc"))
+    monkeypatch.setattr(sd_tag_batch.shared.cmd_opts, flag, True, raising=False)
+    opts.img2img_batch_interrogator_clip_flavor_cache = True
+    # The stand-in has no Interrogator, the cached flavor ranking fails after loading and falls back to image_to_prompt
+    processor.clip_ext_batch([make_image(10)], "ViT-L-14/openai", "fast")
+    assert calls[:3] == ["send_everything_to_cpu", "torch_gc", ("load", "ViT-L-14/openai")]
+
+    monkeypatch.setattr(sd_tag_batch.shared.cmd_opts, flag, False)
+    calls.clear()
+    processor.clip_ext.unload()
+    processor.load_clip_ext_model("ViT-L-14/openai")
+    assert calls == [("unload",), ("load", "ViT-L-14/openai")]
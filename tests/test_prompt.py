@@ -0,0 +1,43 @@
+"""
+The parsed base prompt behind "Insert at index": splicing, clamping and the part labels of the insertion preview.
+"""
+import pytest
+
+from conftest import sd_tag_batch
+
+PROMPT = "<lora:detail:0.5>, masterpiece, (long hair, blue eyes:1.2), [smile], \\(artist\\), solo"
+
+
+@pytest.mark.parametrize("prompt", [PROMPT, "a, b, c", "single", " a ,, b , "])
+def test_splice_matches_join(prompt):
+    parsed = sd_tag_batch.parse_prompt(prompt)
+    parts = [part.strip() for part in prompt.split(",") if part.strip()]
+    for index in range(len(parts) + 1):
+        assert parsed.splice(index, "tags") == ", ".join(parts[:index] + ["tags"] + parts[index:])
+
+
+def test_splice_clamps_the_index():
+    parsed = sd_tag_batch.parse_prompt("a, b, c")
+    assert parsed.splice(9, "x") == "a, b, c, x"
+    assert parsed.splice(-2, "x") == "x, a, b, c"
+    assert parsed.splice("2", "x") == "a, b, x, c"
+    assert parsed.splice("two", "x") == "x, a, b, c"
+    assert sd_tag_batch.parse_prompt("").splice(3, "x") == "x"
+
+
+def test_labels():
+    parsed = sd_tag_batch.parse_prompt(PROMPT)
+    assert parsed.parts == ("<lora:detail:0.5>", "masterpiece", "(long hair", "blue eyes:1.2)", "[smile]", "\\(artist\\)", "solo")
+    assert parsed.labels == ("lora", None, "attention", "attention", "attention", None, None)
+    assert parsed.depths == (0, 0, 0, 1, 0, 0, 0)
+
+
+def test_highlights_mark_the_insert_position():
+    parsed = sd_tag_batch.parse_prompt("<lora:x:1>, a, (b:1.1)")
+    assert parsed.highlights(2) == [("<lora:x:1>", "lora"), ("a", None), ("<interrogation>", "insert"), ("(b:1.1)", "attention")]
+    assert parsed.highlights(7)[-1] == ("<interrogation>", "insert")
+
+
+def test_parse_is_cached():
+    assert sd_tag_batch.parse_prompt("a, b") is sd_tag_batch.parse_prompt("a, b")
+    assert sd_tag_batch.parse_prompt(None).parts == ()
@@ -0,0 +1,129 @@
+"""
+interrogate_many and interrogate_shard with a stand-in custom interrogator, in particular what an interrupt leaves behind.
+"""
+import json
+import os
+
+import pytest
+
+from conftest import gray, make_image, sd_tag_batch
+
+
+@pytest.fixture
+def gray_tagger(processor, state):
+    calls = []
+
+    def tag(images):
+        calls.append(len(images))
+        return [f"gray {gray(image)}" for image in images]
+
+    sd_tag_batch.register_interrogator("Gray Tagger", tag, tier=0)
+    yield calls
+    sd_tag_batch.unregister_interrogator("Gray Tagger")
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for level in range(6):
+        make_image(level * 10).save(input_dir / f"{level}.png")
+    return str(input_dir)
+
+
+def test_interrogate_many_returns_results_in_input_order(processor, gray_tagger):
+    results = processor.interrogate_many([make_image(level) for level in (30, 10, 20)], model_selection=["Gray Tagger"], stream_chunk_size=2)
+    assert [result.interrogation for result in results] == ["gray 30", "gray 10", "gray 20"]
+    assert gray_tagger == [2, 1]
+
+
+def test_interrogate_many_raises_when_interrupted(processor, gray_tagger, state):
+    def interrupt_on_second_chunk(images):
+        if len(gray_tagger) == 1:
+            state.interrupted = True
+        gray_tagger.append(len(images))
+        return ["tag"] * len(images)
+
+    sd_tag_batch.register_interrogator("Gray Tagger", interrupt_on_second_chunk, tier=0)
+    with pytest.raises(sd_tag_batch.InterrogationInterrupted):
+        processor.interrogate_many([make_image(level) for level in range(6)], model_selection=["Gray Tagger"], stream_chunk_size=2)
+    # The third chunk never ran
+    assert gray_tagger == [2, 2]
+
+
+def read_lines(path):
+    with open(path, "r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_interrupted_shard_writes_only_finished_images(processor, gray_tagger, state, image_dir, tmp_path):
+    output_dir = str(tmp_path / "out")
+    tag = lambda images: [f"gray {gray(image)}" for image in images]
+
+    def interrupt_on_second_chunk(images):
+        gray_tagger.append(len(images))
+        if len(gray_tagger) == 2:
+            # The interrupt lands while the second chunk is being interrogated
+            state.interrupted = True
+        return tag(images)
+
+    # Two models so the interrupt is seen before the second one runs on the chunk
+    sd_tag_batch.register_interrogator("Gray Tagger", interrupt_on_second_chunk, tier=0)
+    sd_tag_batch.register_interrogator("Slow Tagger", tag, tier=3)
+    config = sd_tag_batch.InterrogationConfig(model_selection=["Gray Tagger", "Slow Tagger"], stream_chunk_size=2)
+    result = processor.interrogate_shard(image_dir, output_dir, 0, 1, config)
+
+    shard_path = os.path.join(output_dir, sd_tag_batch.shard_file_name(0, 1))
+    assert result == {"shard_file": shard_path, "completed": 2, "done": False}
+    assert [line["path"] for line in read_lines(shard_path)] == ["0.png", "1.png"]
+    assert not os.path.exists(f"{shard_path}.done")
+
+    # A rerun picks up the rest and finishes the shard
+    state.interrupted = False
+    sd_tag_batch.register_interrogator("Gray Tagger", tag, tier=0)
+    result = processor.interrogate_shard(image_dir, output_dir, 0, 1, config)
+    assert result == {"shard_file": shard_path, "completed": 6, "done": True}
+    lines = read_lines(shard_path)
+    assert [line["path"] for line in lines] == [f"{level}.png" for level in range(6)]
+    assert all(line["interrogation"] == f"gray {int(line['path'][0]) * 10}" for line in lines)
+    assert os.path.exists(f"{shard_path}.done")
+    assert sd_tag_batch.merge_shards(output_dir)["images"] == 6
+
+
+def test_shards_split_disjointly_and_merge_covers_all(processor, gray_tagger, tmp_path):
+    input_dir = tmp_path / "in"
+    (input_dir / "sub").mkdir(parents=True)
+    names = [f"{level}.png" for level in range(8)] + [f"sub/{level}.png" for level in range(8, 12)]
+    for level, name in enumerate(names):
+        make_image(level * 10).save(input_dir / name)
+    output_dir = str(tmp_path / "out")
+    config = sd_tag_batch.InterrogationConfig(model_selection=["Gray Tagger"], stream_chunk_size=2)
+
+    shard_paths = []
+    for shard_index in range(3):
+        result = processor.interrogate_shard(str(input_dir), output_dir, shard_index, 3, config)
+        assert result["done"]
+        shard_paths.append({line["path"] for line in read_lines(result["shard_file"])})
+        if shard_index == 1:
+            with pytest.raises(ValueError, match="Shards not finished"):
+                sd_tag_batch.merge_shards(output_dir)
+            partial = sd_tag_batch.merge_shards(output_dir, require_complete=False)
+            assert partial["missing_shards"] == [2]
+            assert partial["images"] == len(shard_paths[0]) + len(shard_paths[1])
+    assert all(shard_paths)
+    assert sum(len(paths) for paths in shard_paths) == len(names)
+    assert set().union(*shard_paths) == set(names)
+
+    # A line repeated by a rerun is written once
+    first_shard = os.path.join(output_dir, sd_tag_batch.shard_file_name(0, 3))
+    with open(first_shard, "r", encoding="utf-8") as file:
+        line = file.readline()
+    with open(first_shard, "a", encoding="utf-8") as file:
+        file.write(line)
+
+    result = sd_tag_batch.merge_shards(output_dir)
+    assert result["images"] == len(names) and result["shard_count"] == 3 and result["missing_shards"] == []
+    lines = read_lines(result["manifest"])
+    assert [line["path"] for line in lines] == sorted(names)
+    assert all(line["interrogation"] == f"gray {names.index(line['path']) * 10}" for line in lines)
+    assert sorted(os.listdir(output_dir)) == sorted(["manifest.jsonl"] + [f"{sd_tag_batch.shard_file_name(i, 3)}{suffix}" for i in range(3) for suffix in ("", ".done")])
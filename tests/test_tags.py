@@ -0,0 +1,81 @@
+"""
+Tag assembly policies across the model outputs of one image, and the tag statistics of a batch.
+"""
+import pytest
+
+from conftest import sd_tag_batch
+
+
+@pytest.fixture
+def assembly():
+    assembly = sd_tag_batch.TagAssembly()
+    assembly.add("WD14 ViT v1", "a, b, c", {"a": 0.9, "b": 0.4, "c": 0.7}, family="WD (EXT)")
+    assembly.add("Deepbooru (Native)", "b, d")
+    return assembly
+
+
+def test_raw_keeps_every_model_output(assembly):
+    assert assembly.raw == "a, b, c, b, d, "
+
+
+def test_keep_first(assembly):
+    assert assembly.assemble() == "a, b, c, d"
+    assert assembly.assemble("keep-first", max_tags=2) == "a, b"
+
+
+def test_highest_confidence(assembly):
+    # b keeps its WD confidence although Deepbooru reported none, d has no confidence at all and goes last
+    assert assembly.assemble("highest-confidence") == "a, c, b, d"
+
+
+def test_highest_confidence_reads_ranked_tags():
+    assembly = sd_tag_batch.TagAssembly()
+    assembly.add("CLIP (EXT)", "x, (y:0.95), (z:0.5)")
+    assert assembly.assemble("highest-confidence") == "(y:0.95), (z:0.5), x"
+
+
+def test_model_priority(assembly):
+    assert assembly.assemble("model-priority", ["Deepbooru (Native)"]) == "b, d, a, c"
+    # The model_selection entry stands for all its models, unlisted models keep the order of first appearance
+    assert assembly.assemble("model-priority", ["WD (EXT)", "Deepbooru (Native)"]) == "a, b, c, d"
+    assert assembly.assemble("model-priority", ["Unlisted"]) == "a, b, c, d"
+
+
+def test_unknown_policy(assembly):
+    with pytest.raises(ValueError, match="Unknown assembly policy"):
+        assembly.assemble("random")
+
+
+def test_provenance(assembly):
+    assert assembly.provenance("b, d") == {
+        "models": ["WD14 ViT v1", "Deepbooru (Native)"],
+        "tags": {"b": [[0, 0.4], 1], "d": [1]},
+    }
+
+
+def test_statistics_counts():
+    stats = sd_tag_batch.TagStatistics()
+    stats.record_model("Deepbooru (Native)", "1girl, solo, smile")
+    stats.record_model("WD (EXT)", "1girl, long_hair")
+    stats.record_filter("custom", "1girl, solo, smile, long_hair", "1girl, solo, long_hair")
+    stats.record_final("1girl, solo, long_hair")
+    stats.record_final("1girl, long hair")
+
+    result = stats.as_dict()
+    assert result["images"] == 2
+    assert result["interrogated_tags"] == {"1girl": 2, "solo": 1, "smile": 1, "long_hair": 1}
+    assert result["model_tags"]["WD (EXT)"] == {"1girl": 1, "long_hair": 1}
+    assert result["filtered_tags"] == {"custom": {"smile": 1}}
+    assert result["final_tags"] == {"1girl": 2, "solo": 1, "long_hair": 1, "long hair": 1}
+
+
+def test_statistics_suggestions():
+    stats = sd_tag_batch.TagStatistics()
+    assert stats.suggest_filter() == []
+    for text in ["1girl, long_hair, smile", "1girl, long hair", "1girl, long hair, (smile:1.2)", "solo, smile"]:
+        stats.record_model("WD (EXT)", text)
+        stats.record_final(text)
+    assert stats.suggest_filter() == ["1girl", "smile", "long hair"]
+    assert stats.suggest_filter(min_share=0.7) == ["1girl"]
+    assert sorted(stats.suggest_replace()) == [("(smile:1.2)", "smile"), ("long_hair", "long hair")]
+    assert stats.suggest_replace(limit=1) == [("long_hair", "long hair")]
@@ -0,0 +1,189 @@
+"""
+Model timeouts and the micro-batching scheduler with interrogators that hang until released.
+"""
+import threading
+import time
+
+import pytest
+
+from conftest import make_image, sd_tag_batch
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = sd_tag_batch.MicroBatchScheduler(max_batch=1, max_wait_ms=0)
+    monkeypatch.setattr(sd_tag_batch, "interrogation_scheduler", scheduler)
+    return scheduler
+
+
+@pytest.fixture
+def timeouts(monkeypatch, scheduler):
+    timeouts = sd_tag_batch.ModelTimeouts()
+    monkeypatch.setattr(sd_tag_batch, "model_timeouts", timeouts)
+    return timeouts
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def test_abandoned_dispatcher_is_replaced_for_queued_requests(scheduler, release):
+    started = threading.Event()
+
+    def hang(images):
+        started.set()
+        release.wait(5)
+        return ["late"] * len(images)
+
+    hung = scheduler.submit("hung model", hang, "a")
+    assert started.wait(5)
+    # Queued behind the hung batch, nothing else will be submitted
+    queued = scheduler.submit("other model", lambda images: [f"done {image}" for image in images], "b")
+    scheduler.abandon_dispatcher()
+    assert queued.result(timeout=5) == "done b"
+    release.set()
+    assert hung.result(timeout=5) == "late"
+
+
+def test_abandoned_dispatcher_holds_back_the_hung_model(scheduler, release):
+    started = threading.Event()
+    running = []
+
+    def hang(images):
+        started.set()
+        release.wait(5)
+        return ["late"] * len(images)
+
+    def record(images):
+        running.append(release.is_set())
+        return ["done"] * len(images)
+
+    hung = scheduler.submit(("CLIP (EXT)", "ViT-L-14/openai"), hang, "a")
+    assert started.wait(5)
+    same_model = scheduler.submit(("CLIP (EXT)", "ViT-H-14/laion2b_s32b_b79k"), record, "b")
+    other_model = scheduler.submit(("WD (EXT)", "wd-v1-4-vit-tagger"), record, "c")
+    scheduler.abandon_dispatcher()
+    # The other model runs right away, the hung one's queue waits for its batch to return
+    assert other_model.result(timeout=5) == "done"
+    assert not same_model.done()
+    release.set()
+    assert same_model.result(timeout=5) == "done"
+    assert hung.result(timeout=5) == "late"
+    assert running == [False, True]
+
+
+class HangingClipExt:
+    def __init__(self, release):
+        self.release = release
+        self.running = 0
+        self.overlaps = 0
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def enter(self, call):
+        with self.lock:
+            self.calls.append(call)
+            self.overlaps += self.running > 0
+            self.running += 1
+
+    def leave(self):
+        with self.lock:
+            self.running -= 1
+
+    def load(self, clip_model):
+        pass
+
+    def unload(self):
+        self.enter("unload")
+        self.leave()
+
+    def image_to_prompt(self, image, mode, clip_model):
+        self.enter(mode)
+        try:
+            if mode == "best":
+                self.release.wait(5)
+            return f"clip {mode}"
+        finally:
+            self.leave()
+
+
+def test_clip_ext_is_not_reused_while_an_abandoned_call_runs(processor, timeouts, release):
+    clip_ext = HangingClipExt(release)
+    processor.clip_ext = clip_ext
+    config = sd_tag_batch.InterrogationConfig(
+        model_selection=["CLIP (EXT)"], clip_ext_model=["ViT-L-14/openai", "ViT-H-14/laion2b_s32b_b79k"], clip_ext_mode="best",
+        model_timeouts={"CLIP (EXT)": 0.05}, timeout_fallback="cheaper",
+    )
+    results = processor.interrogate_many([make_image(10)], config)
+    # The first CLIP model timed out, the second one waits for the same interrogator, Deepbooru stands in for both
+    assert results[0].raw == "db 10, 1girl, solo, looking at viewer, db 10, 1girl, solo, looking at viewer"
+    assert clip_ext.calls == ["best"]
+    assert timeouts.busy("CLIP (EXT)")
+
+    release.set()
+    timeouts.abandoned["CLIP (EXT)"].result(timeout=5)
+    results = processor.interrogate_many([make_image(10)], config)
+    assert results[0].raw == "clip best, clip best"
+    assert clip_ext.overlaps == 0
+
+
+def test_models_load_and_unload_once_per_call(processor, opts, monkeypatch):
+    scheduler = sd_tag_batch.MicroBatchScheduler(max_batch=2, max_wait_ms=0)
+    monkeypatch.setattr(sd_tag_batch, "interrogation_scheduler", scheduler)
+    opts.img2img_batch_interrogator_scheduler = True
+    config = sd_tag_batch.InterrogationConfig(
+        model_selection=["CLIP (EXT)", "WD (EXT)"], clip_ext_model=["ViT-L-14/openai", "ViT-H-14/laion2b_s32b_b79k"],
+        wd_ext_model=["WD14 ViT v1"], stream_chunk_size=3,
+    )
+    results = processor.interrogate_many([make_image(level) for level in range(0, 100, 10)], config)
+    # Ten images in four chunks and micro-batches of two: every model goes over all of them, then unloads
+    assert len(results) == 10
+    clip_calls = [call for call in processor.clip_ext.calls if call[0] != "image_to_prompt"]
+    assert clip_calls == [("load", "ViT-L-14/openai"), ("unload",), ("load", "ViT-H-14/laion2b_s32b_b79k"), ("unload",)]
+    assert processor.wd_ext_utils.interrogators["wd-v1-4-vit-tagger"].calls == ["load", "unload"]
+
+
+def test_shard_unloads_once_after_all_chunks(processor, tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    for level in range(5):
+        make_image(level * 10).save(input_dir / f"{level}.png")
+    config = sd_tag_batch.InterrogationConfig(model_selection=["CLIP (EXT)", "WD (EXT)"], wd_ext_model=["WD14 ViT v1"], stream_chunk_size=2)
+    assert processor.interrogate_shard(str(input_dir), str(tmp_path / "out"), 0, 1, config)["done"]
+    assert [call for call in processor.clip_ext.calls if call[0] != "image_to_prompt"] == [("load", "ViT-L-14/openai"), ("unload",)]
+    assert processor.wd_ext_utils.interrogators["wd-v1-4-vit-tagger"].calls == ["load", "unload"]
+
+
+class SlowClipExt(HangingClipExt):
+    def image_to_prompt(self, image, mode, clip_model):
+        self.enter(mode)
+        try:
+            time.sleep(0.1)
+            return f"clip {mode}"
+        finally:
+            self.leave()
+
+
+def test_queue_wait_does_not_count_against_a_timeout(processor, opts, timeouts, scheduler, release):
+    opts.img2img_batch_interrogator_scheduler = True
+    clip_ext = SlowClipExt(release)
+    processor.clip_ext = clip_ext
+    # Caller B: slow CLIP (EXT) micro-batches of one image each, no timeout
+    clip_config = sd_tag_batch.InterrogationConfig(model_selection=["CLIP (EXT)"], unload_clip_models_afterwords=False)
+    clip_results = []
+    caller_b = threading.Thread(target=lambda: clip_results.extend(processor.interrogate_many([make_image(level) for level in range(0, 60, 10)], clip_config, cancelled=lambda: False)))
+    caller_b.start()
+    while not clip_ext.calls:
+        time.sleep(0.01)
+    # Caller A: a fast WD pass with a tight timeout, queued behind B's batches
+    wd_config = sd_tag_batch.InterrogationConfig(model_selection=["WD (EXT)"], wd_ext_model=["WD14 ViT v1"], model_timeouts={"WD (EXT)": 0.05})
+    wd_results = processor.interrogate_many([make_image(10), make_image(20)], wd_config, cancelled=lambda: False)
+    caller_b.join(10)
+
+    assert all(result.raw.startswith("1girl, long hair") for result in wd_results)
+    assert not timeouts.timeouts
+    assert [result.raw for result in clip_results] == ["clip best"] * 6
+    assert clip_ext.overlaps == 0